@@ -98,8 +98,13 @@ defs_serialqueue = """
     void serialqueue_free_commandqueue(struct command_queue *cq);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_multi(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *msgs, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
         , int receive_window);
@@ -113,6 +118,9 @@ defs_serialqueue = """
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
+    int timerfd_alloc(void);
+    int timerfd_set_waketime(int fd, double waketime);
+    int eventfd_alloc(void);
 """
 
 defs_std = """
@@ -9,6 +9,8 @@
 #include <stdint.h> // uint8_t
 #include <stdio.h> // fprintf
 #include <string.h> // strerror
+#include <sys/eventfd.h> // eventfd
+#include <sys/timerfd.h> // timerfd_create
 #include <time.h> // struct timespec
 #include "compiler.h" // __visible
 #include "pyhelper.h" // get_monotonic
@@ -34,6 +36,46 @@ fill_time(double time)
     return (struct timespec) {t, (time - t)*1000000000. };
 }
 
+// Create a non-blocking timerfd for waking up the reactor
+int __visible
+timerfd_alloc(void)
+{
+    int fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC);
+    if (fd < 0)
+        report_errno("timerfd_create", fd);
+    return fd;
+}
+
+// Arm a timerfd to expire at the given get_monotonic() time (or
+// disarm it if waketime is zero)
+int __visible
+timerfd_set_waketime(int fd, double waketime)
+{
+    struct itimerspec its = { .it_interval = {0, 0}, .it_value = {0, 0} };
+    if (waketime) {
+        // CLOCK_MONOTONIC_RAW is not supported by timerfd - use a
+        // relative timeout
+        double delay = waketime - get_monotonic();
+        if (delay < .000000001)
+            delay = .000000001;
+        its.it_value = fill_time(delay);
+    }
+    int ret = timerfd_settime(fd, 0, &its, NULL);
+    if (ret)
+        report_errno("timerfd_settime", ret);
+    return ret;
+}
+
+// Create a non-blocking eventfd for signaling the reactor
+int __visible
+eventfd_alloc(void)
+{
+    int fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (fd < 0)
+        report_errno("eventfd", fd);
+    return fd;
+}
+
 static void
 default_logger(const char *msg)
 {
@@ -3,6 +3,9 @@
 
 double get_monotonic(void);
 struct timespec fill_time(double time);
+int timerfd_alloc(void);
+int timerfd_set_waketime(int fd, double waketime);
+int eventfd_alloc(void);
 void set_python_logging_callback(void (*func)(const char *));
 void errorf(const char *fmt, ...) __attribute__ ((format (printf, 1, 2)));
 void report_errno(char *where, int rc);
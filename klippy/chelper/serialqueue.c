@@ -971,6 +971,27 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Schedule the transmission of several pre-encoded messages.  The
+// messages are stored back to back in 'msgs' with their lengths in
+// 'lens'.
+void __visible
+serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                       , uint8_t *msgs, int *lens, int count
+                       , uint64_t min_clock, uint64_t req_clock)
+{
+    struct list_head list;
+    list_init(&list);
+    int i;
+    for (i=0; i<count; i++) {
+        struct queue_message *qm = message_fill(msgs, lens[i]);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &list);
+        msgs += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &list);
+}
+
 // Like serialqueue_send() but also builds the message to be sent
 void
 serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
@@ -987,40 +1008,52 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages or -1 on exit.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(&sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        // Remove message from queue
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
 
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    debug_queue_add(&sq->old_receive, qm);
+        // Copy message
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        debug_queue_add(&sq->old_receive, qm);
+    }
 
     pthread_mutex_unlock(&sq->lock);
-    return;
+    return count;
+}
 
-exit:
-    pqm->len = -1;
-    pthread_mutex_unlock(&sq->lock);
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) <= 0)
+        pqm->len = -1;
 }
 
 void __visible
@@ -27,6 +27,12 @@ class BedTilt:
         x, y, z, e = newpos
         self.toolhead.move([x, y, z + x*self.x_adjust + y*self.y_adjust
                             + self.z_adjust, e], speed)
+    def move_batch(self, positions, speeds):
+        x_adjust, y_adjust = self.x_adjust, self.y_adjust
+        z_adjust = self.z_adjust
+        return self.toolhead.move_batch(
+            [[x, y, z + x*x_adjust + y*y_adjust + z_adjust, e]
+             for x, y, z, e in positions], speeds)
 
 # Helper script to calibrate the bed tilt
 class BedTiltCalibrate:
@@ -47,7 +47,8 @@ class PIDCalibrate:
         self.gcode.bg_temp(tgt_heater)
         tgt_heater.set_control(old_control)
         if write_file:
-            calibrate.write_file('/tmp/heattest.txt')
+            self.printer.get_reactor().get_worker_pool().run(
+                calibrate.write_file, '/tmp/heattest.txt')
         try:
             Kp, Ki, Kd = calibrate.calc_final_pid()
         except Exception:
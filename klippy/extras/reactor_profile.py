@@ -0,0 +1,29 @@
+# Report the time spent in each reactor callback
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        warn_time = config.getfloat('warn_time', 0.050, above=0.)
+        self.logger = self.printer.logger.getChild('reactor')
+        self.profiler = self.printer.get_reactor().enable_profiler(
+            warn_time, self.logger)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command(
+            'REACTOR_PROFILE', self.cmd_REACTOR_PROFILE,
+            desc=self.cmd_REACTOR_PROFILE_help)
+    cmd_REACTOR_PROFILE_help = "Report time spent in reactor callbacks"
+    def cmd_REACTOR_PROFILE(self, params):
+        count = self.gcode.get_int('COUNT', params, 20, minval=1)
+        reset = self.gcode.get_int('RESET', params, 0)
+        msg = self.profiler.get_report(count)
+        self.logger.info(msg)
+        self.gcode.respond_info(msg)
+        if reset:
+            self.profiler.reset()
+    def stats(self, eventtime):
+        return False, self.profiler.get_interval_stats()
+
+def load_config(config):
+    return ReactorProfile(config)
@@ -0,0 +1,330 @@
+# Reading of plain and compressed g-code files (used by virtual_sdcard)
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, bisect, threading, zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 64 * 1024
+# Compressed bytes decompressed to check the size in a gzip trailer
+GZIP_SAMPLE_SIZE = 256 * 1024
+GZIP_SAMPLE_MAX_OUT = 8 * 1024 * 1024
+# Uncompressed bytes between the saved decompressor states of a file
+CHECKPOINT_DISTANCE = 8 * 1024 * 1024
+
+
+######################################################################
+# Decompressors
+######################################################################
+
+class GzipDecoder:
+    # The zlib decompressor state can be copied, so gzip files can be
+    # restarted from a checkpoint
+    can_copy = True
+    def __init__(self, decomp=None):
+        if decomp is None:
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.decomp = decomp
+    def decompress(self, data):
+        out = [self.decomp.decompress(data)]
+        # Concatenated gzip members
+        data = self.decomp.unused_data
+        while data:
+            self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self.decomp.decompress(data))
+            data = self.decomp.unused_data
+        return "".join(out)
+    def copy(self):
+        return GzipDecoder(self.decomp.copy())
+    @staticmethod
+    def get_data_size(f):
+        # The gzip trailer only stores the uncompressed size (modulo
+        # 2^32) of the last member of the file.  It is checked against
+        # the size estimated from the compression ratio of the start of
+        # the file, so that files with several members or over 4GB are
+        # reported as having an unknown size.
+        f.seek(-4, os.SEEK_END)
+        size = struct.unpack('<I', f.read(4))[0]
+        file_size = f.tell()
+        f.seek(0)
+        data = f.read(GZIP_SAMPLE_SIZE)
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            out_size = len(decomp.decompress(data, GZIP_SAMPLE_MAX_OUT))
+        except zlib.error:
+            return None
+        if decomp.unused_data:
+            # Another member follows the first one
+            return None
+        in_size = len(data) - len(decomp.unconsumed_tail)
+        if in_size == file_size:
+            return size
+        if not in_size:
+            return None
+        estimate = float(out_size) * file_size / in_size
+        if size < estimate / 4. or size + (1 << 32) <= estimate * 4.:
+            return None
+        return size
+
+def read_varint(data, pos):
+    value = shift = 0
+    while 1:
+        b = ord(data[pos])
+        pos += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, pos
+
+class XzDecoder:
+    can_copy = False
+    def __init__(self):
+        self.decomp = lzma.LZMADecompressor()
+    def decompress(self, data):
+        out = []
+        while data:
+            if self.decomp.eof:
+                # Concatenated xz streams (and stream padding)
+                data = data.lstrip('\0')
+                if not data:
+                    break
+                self.decomp = lzma.LZMADecompressor()
+            out.append(self.decomp.decompress(data))
+            data = self.decomp.unused_data
+        return "".join(out)
+    @staticmethod
+    def get_data_size(f):
+        # Sum the uncompressed sizes in the index of the last xz stream
+        f.seek(-12, os.SEEK_END)
+        footer = f.read(12)
+        if footer[10:] != 'YZ':
+            return None
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        f.seek(-12 - index_size, os.SEEK_END)
+        index = f.read(index_size)
+        if index[:1] != '\0':
+            return None
+        count, pos = read_varint(index, 1)
+        size = 0
+        for i in range(count):
+            unpadded_size, pos = read_varint(index, pos)
+            block_size, pos = read_varint(index, pos)
+            size += block_size
+        return size
+
+class ZstdDecoder:
+    can_copy = False
+    def __init__(self):
+        self.decomp = zstandard.ZstdDecompressor().decompressobj()
+    def decompress(self, data):
+        return self.decomp.decompress(data)
+    @staticmethod
+    def get_data_size(f):
+        # The frame header has the content size if it was known when
+        # the file was compressed
+        try:
+            size = zstandard.frame_content_size(f.read(18))
+        except zstandard.ZstdError:
+            return None
+        if size < 0:
+            return None
+        return size
+
+DECODERS = {'.gz': GzipDecoder}
+DECODE_ERRORS = (zlib.error,)
+if lzma is not None:
+    DECODERS['.xz'] = XzDecoder
+    DECODE_ERRORS += (lzma.LZMAError, EOFError)
+if zstandard is not None:
+    DECODERS['.zst'] = ZstdDecoder
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+def get_decoder(fname):
+    # Returns None for files that are not compressed
+    return DECODERS.get(os.path.splitext(fname)[1].lower())
+
+
+######################################################################
+# Decompressed file reader
+######################################################################
+
+# Saved decompressor states of a compressed file.  A file position can
+# be reached by restarting from the nearest checkpoint before it.
+class Checkpoints:
+    def __init__(self, decoder_class):
+        self.lock = threading.Lock()
+        self.positions = [0]
+        self.checkpoints = [(0, 0, None)]
+        self.can_copy = decoder_class.can_copy
+    def note(self, pos, file_pos, decoder):
+        # Called after each block that was decompressed
+        next_pos = self.positions[-1] + CHECKPOINT_DISTANCE
+        if not self.can_copy or pos < next_pos:
+            return
+        with self.lock:
+            if pos >= self.positions[-1] + CHECKPOINT_DISTANCE:
+                self.positions.append(pos)
+                self.checkpoints.append((pos, file_pos, decoder.copy()))
+    def find(self, pos):
+        # Returns the (pos, file_pos, decoder) of the checkpoint
+        with self.lock:
+            i = bisect.bisect_right(self.positions, pos) - 1
+            return self.checkpoints[i]
+
+# File-like reader of the uncompressed data (all positions are
+# positions of the uncompressed data)
+class DecompressedFile:
+    def __init__(self, fname, decoder_class, checkpoints=None):
+        self.name = fname
+        self.decoder_class = decoder_class
+        if checkpoints is None:
+            checkpoints = Checkpoints(decoder_class)
+        self.checkpoints = checkpoints
+        self.file = open(fname, 'rb')
+        self._restart((0, 0, None))
+    def _restart(self, checkpoint):
+        # Continue decompressing from a checkpoint
+        self.data_pos, file_pos, decoder = checkpoint
+        if decoder is None:
+            self.decoder = self.decoder_class()
+        else:
+            self.decoder = decoder.copy()
+        self.file.seek(file_pos)
+        self.file_pos = file_pos
+        self.buf = ""
+        self.buf_pos = 0
+    def _fill(self):
+        # Decompress the next block - returns False at the end of file
+        data = self.file.read(READ_SIZE)
+        if not data:
+            return False
+        self.file_pos += len(data)
+        try:
+            out = self.decoder.decompress(data)
+        except DECODE_ERRORS as e:
+            raise IOError("Unable to decompress %s: %s" % (self.name, e))
+        self.buf = self.buf[self.buf_pos:] + out
+        self.data_pos += self.buf_pos
+        self.buf_pos = 0
+        self.checkpoints.note(self.data_pos + len(self.buf), self.file_pos,
+                              self.decoder)
+        return True
+    def tell(self):
+        return self.data_pos + self.buf_pos
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise IOError("Compressed files only support absolute seeks")
+        checkpoint = self.checkpoints.find(pos)
+        buf_end = self.data_pos + len(self.buf)
+        if pos < self.data_pos or checkpoint[0] > buf_end:
+            self._restart(checkpoint)
+        # Skip the data up to the position
+        while pos > self.data_pos + len(self.buf):
+            self.buf_pos = len(self.buf)
+            if not self._fill():
+                break
+        self.buf_pos = min(pos - self.data_pos, len(self.buf))
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) - self.buf_pos < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self.buf) - self.buf_pos
+        data = self.buf[self.buf_pos:self.buf_pos + size]
+        self.buf_pos += len(data)
+        return data
+    def readline(self):
+        start = self.buf_pos
+        while 1:
+            end = self.buf.find('\n', start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.buf) - self.buf_pos
+            if not self._fill():
+                end = len(self.buf)
+                break
+        line = self.buf[self.buf_pos:end]
+        self.buf_pos = end
+        return line
+    def __iter__(self):
+        while 1:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+    def close(self):
+        self.file.close()
+        self.buf = ""
+        self.buf_pos = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+def new_checkpoints(fname):
+    # Returns None for files that are not compressed
+    decoder_class = get_decoder(fname)
+    if decoder_class is None:
+        return None
+    return Checkpoints(decoder_class)
+
+def open_file(fname, checkpoints=None):
+    decoder_class = get_decoder(fname)
+    if decoder_class is None:
+        return open(fname, 'rb')
+    return DecompressedFile(fname, decoder_class, checkpoints)
+
+def raw_tell(f):
+    # Returns the position in the file as stored on disk
+    if isinstance(f, DecompressedFile):
+        return f.file_pos
+    return f.tell()
+
+def _read_data_size(fname, decoder_class):
+    f = open(fname, 'rb')
+    try:
+        return decoder_class.get_data_size(f)
+    except (IOError, IndexError, struct.error):
+        return None
+    finally:
+        f.close()
+
+# Uncompressed sizes of compressed files (finding the size of a gzip
+# file decompresses the start of it) - entries are only used while the
+# modification time and size of the file are unchanged
+data_size_lock = threading.Lock()
+data_size_cache = {}
+
+def get_data_size(fname):
+    # Returns the uncompressed size of the file (or None if unknown)
+    st = os.stat(fname)
+    decoder_class = get_decoder(fname)
+    if decoder_class is None:
+        return st.st_size
+    key = (st.st_mtime, st.st_size)
+    with data_size_lock:
+        entry = data_size_cache.get(fname)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    size = _read_data_size(fname, decoder_class)
+    with data_size_lock:
+        data_size_cache[fname] = (key, size)
+    return size
+
+def get_listed_size(fname):
+    # Size reported in file listings - the uncompressed size if it is
+    # known, otherwise the size on disk
+    size = get_data_size(fname)
+    if size is None:
+        size = os.path.getsize(fname)
+    return size
@@ -0,0 +1,283 @@
+# Line and layer index of g-code files (used by virtual_sdcard)
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, re, json, bisect
+import sdcard_file
+
+INDEX_VERSION = 3
+# Number of lines between the sampled entries of the index
+LINE_STRIDE = 1000
+# Minimum Z increase of an extruding move that starts a new layer
+LAYER_MIN_HEIGHT = .010
+
+AXES = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3}
+# Command names of moves (including the aliases GCodeParser accepts)
+MOVE_COMMANDS = {'G0': 1, 'G1': 1, 'G00': 1, 'G01': 1}
+
+# Track the g-code state needed to restart a print at any line.
+# Positions are in the coordinates of the g-code file (after G92) and
+# offsets are the X, Y, and Z shifts made by G92 commands (the homed
+# position of an axis is its position plus its offset).
+class GCodeState:
+    def __init__(self, state=None):
+        self.absolutecoord = self.absoluteextrude = True
+        self.pos = [0., 0., 0., 0.]
+        self.offsets = [0., 0., 0.]
+        self.speed = 0.
+        self.extruder = 0
+        self.extruder_temps = {}
+        self.bed_temp = self.fan_speed = 0.
+        if state is not None:
+            self.absolutecoord = state['absolutecoord']
+            self.absoluteextrude = state['absoluteextrude']
+            self.pos = list(state['pos'])
+            self.offsets = list(state['offsets'])
+            self.speed = state['speed']
+            self.extruder = state['extruder']
+            self.extruder_temps = dict([
+                (int(i), t) for i, t in state['extruder_temps'].items()])
+            self.bed_temp = state['bed_temp']
+            self.fan_speed = state['fan_speed']
+    def get_state(self):
+        return {'absolutecoord': self.absolutecoord,
+                'absoluteextrude': self.absoluteextrude,
+                'pos': list(self.pos), 'offsets': list(self.offsets),
+                'speed': self.speed,
+                'extruder': self.extruder,
+                'extruder_temps': dict(self.extruder_temps),
+                'bed_temp': self.bed_temp, 'fan_speed': self.fan_speed}
+    number_chars = '0123456789.+-'
+    args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def _parse_line(self, line):
+        # Split a line into its command and parameter words (a letter
+        # followed by the value) the same way as GCodeParser.parse_line()
+        # - a leading line number is skipped and a checksum is a '*' word
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        line = line.upper()
+        # Fast path - every word is a single letter followed by a number
+        words = line.split()
+        number_chars = self.number_chars
+        for word in words:
+            if not 'A' <= word[0] <= 'Z' or word[1:].lstrip(number_chars):
+                break
+        else:
+            if words and words[0][0] == 'N':
+                del words[0]
+            if not words:
+                return '', words
+            return words[0], words[1:]
+        parts = self.args_r.split(line)[1:]
+        if parts and parts[0] == 'N':
+            del parts[:2]
+        if not parts:
+            return '', parts
+        # Only single letter parameters are of interest
+        return parts[0] + parts[1].strip(), [
+            parts[i] + parts[i+1].strip() for i in range(2, len(parts), 2)
+            if len(parts[i]) == 1]
+    def _get_params(self, words):
+        params = {}
+        for w in words:
+            try:
+                params[w[0]] = float(w[1:])
+            except ValueError:
+                pass
+        return params
+    def update(self, line):
+        # Returns True if the line is a G0/G1 move
+        cmd, words = self._parse_line(line)
+        if not cmd:
+            return False
+        if cmd in MOVE_COMMANDS:
+            pos = self.pos
+            for w in words:
+                axis = w[0]
+                try:
+                    v = float(w[1:])
+                except ValueError:
+                    continue
+                if axis == 'F':
+                    self.speed = v
+                    continue
+                i = AXES.get(axis)
+                if i is None:
+                    continue
+                if not self.absolutecoord or (
+                        i == 3 and not self.absoluteextrude):
+                    pos[i] += v
+                else:
+                    pos[i] = v
+            return True
+        if cmd == 'G90':
+            self.absolutecoord = True
+        elif cmd == 'G91':
+            self.absolutecoord = False
+        elif cmd == 'M82':
+            self.absoluteextrude = True
+        elif cmd == 'M83':
+            self.absoluteextrude = False
+        elif cmd == 'G92':
+            params = self._get_params(words)
+            if not params:
+                params = {'X': 0., 'Y': 0., 'Z': 0., 'E': 0.}
+            for axis, i in AXES.items():
+                if axis not in params:
+                    continue
+                if i < 3:
+                    self.offsets[i] += self.pos[i] - params[axis]
+                self.pos[i] = params[axis]
+        elif cmd in ('M104', 'M109'):
+            params = self._get_params(words)
+            index = int(params.get('T', params.get('P', self.extruder)))
+            self.extruder_temps[index] = params.get('S', 0.)
+        elif cmd in ('M140', 'M190'):
+            self.bed_temp = self._get_params(words).get('S', 0.)
+        elif cmd == 'M106':
+            params = self._get_params(words)
+            if not params.get('P', 0.):
+                self.fan_speed = params.get('S', 255.) / 255.
+        elif cmd == 'M107':
+            if not self._get_params(words).get('P', 0.):
+                self.fan_speed = 0.
+        elif cmd[0] == 'T' and cmd[1:].isdigit():
+            self.extruder = int(cmd[1:])
+        return False
+    def get_restore_script(self, lift_z):
+        # G-Code commands that restore this state on a printer that was
+        # just homed (the head is moved to the position above the print
+        # at lift_z and the G92 offsets of the file are then set again)
+        script = []
+        if self.bed_temp:
+            script.append("M140 S%.3f" % (self.bed_temp,))
+        temps = sorted(self.extruder_temps.items())
+        for index, temp in temps:
+            script.append("M104 T%d S%.3f" % (index, temp))
+        if self.bed_temp:
+            script.append("M190 S%.3f" % (self.bed_temp,))
+        for index, temp in temps:
+            if temp:
+                script.append("M109 T%d S%.3f" % (index, temp))
+        script.append("T%d" % (self.extruder,))
+        if self.fan_speed:
+            script.append("M106 S%.3f" % (self.fan_speed * 255.,))
+        else:
+            script.append("M107")
+        x, y, z, e = self.pos
+        x_offset, y_offset, z_offset = self.offsets
+        script.extend([
+            "G90",
+            "G1 Z%.3f F600" % (z + z_offset + lift_z,),
+            "G1 X%.3f Y%.3f F6000" % (x + x_offset, y + y_offset),
+            "G1 Z%.3f F600" % (z + z_offset,),
+            "G92 X%.5f Y%.5f Z%.5f E%.5f" % (x, y, z, e)])
+        if not self.absolutecoord:
+            script.append("G91")
+        script.append(self.absoluteextrude and "M82" or "M83")
+        if self.speed:
+            script.append("G1 F%.3f" % (self.speed,))
+        return "\n".join(script)
+
+# Find the line at every LINE_STRIDE lines and the first line of each
+# layer along with the g-code state at that line
+def build_index(f):
+    state = GCodeState()
+    lines = []
+    layers = []
+    layer_z = None
+    # Layers start after the last line that changed Z
+    z_change = [0, 0, state.get_state()]
+    line_num = offset = 0
+    for line in f:
+        if not line_num % LINE_STRIDE:
+            lines.append([line_num, offset, state.get_state()])
+        line_num += 1
+        offset += len(line)
+        x, y, z, e = state.pos
+        if not state.update(line):
+            continue
+        pos = state.pos
+        if pos[2] != z:
+            z_change = [line_num, offset, state.get_state()]
+        if pos[3] > e and (pos[0] != x or pos[1] != y):
+            if layer_z is None or pos[2] >= layer_z + LAYER_MIN_HEIGHT:
+                layers.append(z_change)
+                layer_z = pos[2]
+    return {'version': INDEX_VERSION, 'lines': lines, 'layers': layers,
+            'line_count': line_num}
+
+def get_index_name(fname):
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, '.' + basename + '.lineidx')
+
+def write_index(fname):
+    st = os.stat(fname)
+    f = sdcard_file.open_file(fname)
+    index = build_index(f)
+    f.close()
+    index['size'] = st.st_size
+    index['mtime'] = int(st.st_mtime)
+    index_name = get_index_name(fname)
+    tmpname = index_name + ".tmp"
+    f = open(tmpname, 'wb')
+    json.dump(index, f)
+    f.close()
+    os.rename(tmpname, index_name)
+
+class GCodeIndex:
+    def __init__(self, index):
+        self.line_count = index['line_count']
+        self.lines = index['lines']
+        self.line_nums = [l[0] for l in self.lines]
+        self.layers = index['layers']
+    def get_layer_count(self):
+        return len(self.layers)
+    def find_layer(self, layer):
+        # Returns the (line, offset, state) of the start of the layer
+        line_num, offset, state = self.layers[layer]
+        return line_num, offset, GCodeState(state)
+    def find_line(self, line_num):
+        # Returns the nearest indexed (line, offset, state) before line
+        i = bisect.bisect_right(self.line_nums, line_num) - 1
+        line_num, offset, state = self.lines[i]
+        return line_num, offset, GCodeState(state)
+
+def load_index(fname):
+    # Returns None if the index is missing or out of date
+    try:
+        st = os.stat(fname)
+        f = open(get_index_name(fname), 'rb')
+        index = json.load(f)
+        f.close()
+        if (index.get('version') != INDEX_VERSION
+            or index['size'] != st.st_size
+            or index['mtime'] != int(st.st_mtime)):
+            return None
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return GCodeIndex(index)
+
+def scan_to_line(fname, line_num, offset, state, target_line,
+                 checkpoints=None):
+    # Update state with the lines from line_num up to target_line
+    f = sdcard_file.open_file(fname, checkpoints)
+    f.seek(offset)
+    while line_num < target_line:
+        line = f.readline()
+        if not line:
+            break
+        state.update(line)
+        line_num += 1
+        offset += len(line)
+    f.close()
+    return line_num, offset, state
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s <gcode file>\n" % (sys.argv[0],))
+        sys.exit(-1)
+    write_index(sys.argv[1])
+
+if __name__ == '__main__':
+    main()
@@ -44,12 +44,15 @@ class PrinterServo:
         self.set_pwm(print_time, width * self.width_to_value)
     cmd_SET_SERVO_help = "Set servo angle"
     def cmd_SET_SERVO(self, params):
-        print_time = self.printer.lookup_object('toolhead').get_last_move_time()
+        toolhead = self.printer.lookup_object('toolhead')
         if 'WIDTH' in params:
-            self.set_pulse_width(print_time,
-                                 self.gcode.get_float('WIDTH', params))
+            width = self.gcode.get_float('WIDTH', params)
+            toolhead.register_lookahead_callback(
+                (lambda print_time: self.set_pulse_width(print_time, width)))
         else:
-            self.set_angle(print_time, self.gcode.get_float('ANGLE', params))
+            angle = self.gcode.get_float('ANGLE', params)
+            toolhead.register_lookahead_callback(
+                (lambda print_time: self.set_angle(print_time, angle)))
 
 def load_config_prefix(config):
     return PrinterServo(config)
@@ -3,7 +3,152 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os
+import os, sys, bisect, subprocess, threading, Queue
+import sdcard_index, sdcard_file
+
+# Maximum lines per batch (a pause or the progress only takes effect
+# between batches, and a batch waits for the toolhead to catch up)
+MOVE_BATCH_LINES = 64
+
+READ_SIZE = 64 * 1024
+READ_AHEAD_COUNT = 16
+
+# Read (and decompress) the print file in a background thread so that
+# slow storage does not delay the dispatch of commands
+class FileReadAhead:
+    def __init__(self, fname, pos, checkpoints):
+        self.queue = Queue.Queue(READ_AHEAD_COUNT)
+        self.must_stop = False
+        # Position in the file on disk after the last returned block
+        self.raw_pos = 0
+        thread = threading.Thread(target=self._read,
+                                  args=(fname, pos, checkpoints))
+        thread.daemon = True
+        thread.start()
+    def _read(self, fname, pos, checkpoints):
+        try:
+            f = sdcard_file.open_file(fname, checkpoints)
+            f.seek(pos)
+            while not self.must_stop:
+                data = f.read(READ_SIZE)
+                self.queue.put((data, sdcard_file.raw_tell(f), None))
+                if not data:
+                    break
+            f.close()
+        except:
+            self.queue.put((None, 0, sys.exc_info()))
+    def _check_result(self, result):
+        data, raw_pos, exc_info = result
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.raw_pos = raw_pos
+        return data
+    def get_nowait(self):
+        # Returns None if the next block has not been read yet
+        try:
+            return self._check_result(self.queue.get_nowait())
+        except Queue.Empty:
+            return None
+    def get(self):
+        return self._check_result(self.queue.get())
+    def get_buffered(self):
+        return self.queue.qsize()
+    def stop(self):
+        # Unblock the reader thread (it exits after its current read)
+        self.must_stop = True
+        try:
+            while 1:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+ESTIMATE_SCRIPT = os.path.join(os.path.dirname(__file__),
+                               '../../scripts/print_estimate.py')
+INDEX_SCRIPT = os.path.join(os.path.dirname(__file__), 'sdcard_index.py')
+INDEX_CHECK_TIME = 2.
+
+# Build an index of a g-code file in a low priority background process
+class IndexJob:
+    def __init__(self, sd, name, fname, load_func, args, set_index):
+        self.sd = sd
+        self.reactor = sd.reactor
+        self.name = name
+        self.fname = fname
+        self.load_func = load_func
+        self.set_index = set_index
+        devnull = open(os.devnull, 'wb')
+        self.process = subprocess.Popen(
+            [sys.executable] + args, stdout=devnull, stderr=devnull,
+            close_fds=True, preexec_fn=(lambda: os.nice(19)))
+        devnull.close()
+        self.timer = self.reactor.register_timer(
+            self._check_process, self.reactor.monotonic() + INDEX_CHECK_TIME)
+    def stop(self):
+        self.reactor.unregister_timer(self.timer)
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+    def _check_process(self, eventtime):
+        res = self.process.poll()
+        if res is None:
+            return eventtime + INDEX_CHECK_TIME
+        self.reactor.unregister_timer(self.timer)
+        self.sd.index_jobs.remove(self)
+        if res:
+            self.sd.logger.info("Unable to build %s (%d)", self.name, res)
+            return self.reactor.NEVER
+        index = self.sd.worker_pool.run(self.load_func, self.fname)
+        if index is not None and self.sd.get_current_file_name() == self.fname:
+            self.set_index(index, "built")
+        return self.reactor.NEVER
+
+# Map of file positions to the planned print time of a g-code file
+# (generated by scripts/print_estimate.py)
+class PrintTimeIndex:
+    def __init__(self, offsets, times, total_time):
+        self.offsets = offsets
+        self.times = times
+        self.total_time = total_time
+    def get_time(self, pos):
+        offsets = self.offsets
+        i = bisect.bisect_right(offsets, pos)
+        if not i:
+            return 0.
+        if i >= len(offsets):
+            return self.total_time
+        start_pos, end_pos = offsets[i-1], offsets[i]
+        start_time, end_time = self.times[i-1], self.times[i]
+        return start_time + ((end_time - start_time) * (pos - start_pos)
+                             / (end_pos - start_pos))
+    def get_progress(self, pos):
+        if not self.total_time:
+            return 0.
+        return self.get_time(pos) / self.total_time
+
+def get_time_index_name(fname):
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, '.' + basename + '.timeidx')
+
+def load_time_index(fname):
+    # Returns None if the index is missing or out of date
+    try:
+        f = open(get_time_index_name(fname), 'rb')
+        header = f.readline().split()
+        st = os.stat(fname)
+        if (len(header) != 3 or int(header[0]) != st.st_size
+            or int(header[1]) != int(st.st_mtime)):
+            f.close()
+            return None
+        offsets = []
+        times = []
+        for line in f:
+            offset, t = line.split()
+            offsets.append(int(offset))
+            times.append(float(t))
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    return PrintTimeIndex(offsets, times, float(header[2]))
 
 class VirtualSD:
     def __init__(self, config):
@@ -14,10 +159,23 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Size of the file on disk and the position in it (used for the
+        # progress of compressed files with an unknown uncompressed size)
+        self.raw_size = self.raw_position = 0
+        # Decompressor checkpoints of a compressed file
+        self.checkpoints = None
+        # File indexes (planned print time and line/layer positions)
+        self.use_time_index = config.getboolean('time_index', True)
+        self.use_line_index = config.getboolean('line_index', True)
+        self.resume_z_lift = config.getfloat('resume_z_lift', 2., minval=0.)
+        self.time_index = self.line_index = None
+        self.index_jobs = []
         # Work timer
         self.reactor = printer.get_reactor()
+        self.worker_pool = self.reactor.get_worker_pool()
         self.must_pause_work = False
         self.work_timer = None
+        self.read_ahead = None
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         self.gcode.register_command('M21', None)
@@ -25,6 +183,9 @@ class VirtualSD:
             self.gcode.register_command(cmd, getattr(self, 'cmd_' + cmd))
         for cmd in ['M28', 'M29', 'M30']:
             self.gcode.register_command(cmd, self.cmd_error)
+        self.gcode.register_command(
+            'SDCARD_RESUME', self.cmd_SDCARD_RESUME,
+            desc=self.cmd_SDCARD_RESUME_help)
         self.done_cb = []
     def get_current_file_name(self):
         try:
@@ -34,6 +195,9 @@ class VirtualSD:
     def printer_state(self, state):
         if state == 'shutdown' and self.work_timer is not None:
             self.must_pause_work = True
+            if self.checkpoints is not None and not self.checkpoints.can_copy:
+                # Seeking would decompress the file from the start
+                return
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
@@ -48,27 +212,64 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
-    def get_file_list(self):
+        read_ahead = 0
+        if self.read_ahead is not None:
+            read_ahead = self.read_ahead.get_buffered()
+        return True, "sd_pos=%d sd_read_ahead=%d" % (
+            self.file_position, read_ahead)
+    def _list_files(self):
         dname = self.sdcard_dirname
+        filenames = os.listdir(self.sdcard_dirname)
+        get_listed_size = sdcard_file.get_listed_size
+        return [(fname, get_listed_size(os.path.join(dname, fname)))
+                for fname in filenames if not fname.startswith('.')]
+    def get_file_list(self):
         try:
-            filenames = os.listdir(self.sdcard_dirname)
-            return [(fname, os.path.getsize(os.path.join(dname, fname)))
-                    for fname in filenames]
+            return self.worker_pool.run(self._list_files)
         except:
             self.logger.exception("virtual_sdcard get_file_list")
             raise self.gcode.error("Unable to get file list")
+    def _calc_progress(self):
+        if self.time_index is not None:
+            return self.time_index.get_progress(self.file_position)
+        if not self.file_size:
+            return float(self.raw_position) / self.raw_size
+        return float(self.file_position) / self.file_size
     def get_status(self, eventtime):
         progress = 0.
-        if self.work_timer is not None and self.file_size:
-            progress = float(self.file_position) / self.file_size
+        if self.work_timer is not None and self.raw_size:
+            progress = self._calc_progress()
         return {'progress': progress}
     def register_done_cb(self, cb):
         self.done_cb.append(cb)
     def get_progress(self):
-        if self.current_file is None or not self.file_size:
+        if self.current_file is None or not self.raw_size:
             return .0
-        return float(self.file_position) / self.file_size
+        return self._calc_progress()
+    # File indexes
+    def _stop_indexes(self):
+        self.time_index = self.line_index = None
+        for job in self.index_jobs:
+            job.stop()
+        self.index_jobs = []
+    def _start_index(self, name, fname, load_func, args, set_index):
+        index = self.worker_pool.run(load_func, fname)
+        if index is not None:
+            set_index(index, "loaded")
+            return
+        try:
+            self.index_jobs.append(
+                IndexJob(self, name, fname, load_func, args, set_index))
+        except OSError:
+            self.logger.exception("virtual_sdcard %s", name)
+    def _set_time_index(self, index, how):
+        self.time_index = index
+        self.logger.info("Print time index %s (%.0fs planned)",
+                         how, index.total_time)
+    def _set_line_index(self, index, how):
+        self.line_index = index
+        self.logger.info("Line index %s (%d lines, %d layers)",
+                         how, index.line_count, index.get_layer_count())
     # G-Code commands
     def cmd_error(self, params):
         raise self.gcode.error("SD write not supported")
@@ -88,8 +289,10 @@ class VirtualSD:
             raise self.gcode.error("SD busy")
         if self.current_file is not None:
             self.current_file.close()
-            self.current_file = None
+            self.current_file = self.checkpoints = None
             self.file_position = self.file_size = 0
+            self.raw_size = self.raw_position = 0
+        self._stop_indexes()
         try:
             orig = params['#original']
             filename = orig[orig.find("M23") + 3:].split()[0].strip()
@@ -101,23 +304,46 @@ class VirtualSD:
             filename = filename[1:]
         try:
             fname = os.path.join(self.sdcard_dirname, filename)
-            f = open(fname, 'rb')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+            checkpoints = sdcard_file.new_checkpoints(fname)
+            f, fsize, raw_size = self.worker_pool.run(
+                self._open_file, fname, checkpoints)
         except:
             self.logger.exception("virtual_sdcard file open")
             raise self.gcode.error("Unable to open file")
-        self.gcode.respond("File opened:%s Size:%d" % (filename, fsize))
+        if fsize is None:
+            self.logger.warning(
+                "Uncompressed size of %s is unknown - reporting the"
+                " position in the compressed file", filename)
+        self.gcode.respond("File opened:%s Size:%d" % (
+            filename, fsize or raw_size))
         self.gcode.respond("File selected")
         self.current_file = f
-        self.file_position = 0
-        self.file_size = fsize
+        self.checkpoints = checkpoints
+        self.file_position = self.raw_position = 0
+        self.file_size = fsize or 0
+        self.raw_size = raw_size
         # Reset extruders filament counters
         for i, e in self.printer.extruder_get().items():
             e.raw_filament = 0.
+        if self.use_time_index:
+            config_file = os.path.abspath(
+                self.printer.get_start_arg('config_file'))
+            self._start_index(
+                "print time index", fname, load_time_index,
+                [ESTIMATE_SCRIPT, '--index', get_time_index_name(fname),
+                 config_file, fname], self._set_time_index)
+        if self.use_line_index:
+            self._start_index(
+                "line index", fname, sdcard_index.load_index,
+                [INDEX_SCRIPT, fname], self._set_line_index)
         for cb in self.done_cb:
             cb('loaded')
+    def _open_file(self, fname, checkpoints):
+        f = sdcard_file.open_file(fname, checkpoints)
+        # The size of a compressed file is its uncompressed size (None
+        # if it is not known)
+        fsize = sdcard_file.get_data_size(fname)
+        return f, fsize, os.path.getsize(fname)
     def cmd_M24(self, params):
         # Start/resume SD print
         if self.current_file is None:
@@ -146,31 +372,70 @@ class VirtualSD:
             raise self.gcode.error("SD busy")
         pos = self.gcode.get_int('S', params, minval=0)
         self.file_position = pos
+    cmd_SDCARD_RESUME_help = (
+        "Restore the g-code state and start the SD print at a line or layer."
+        " Args: LINE=<line> | LAYER=<layer>")
+    def cmd_SDCARD_RESUME(self, params):
+        if self.current_file is None:
+            raise self.gcode.error("SD file is not loaded")
+        if self.work_timer is not None:
+            raise self.gcode.error("SD busy")
+        index = self.line_index
+        if index is None:
+            raise self.gcode.error("SD file index is not ready")
+        if 'LAYER' in params:
+            if not index.get_layer_count():
+                raise self.gcode.error("No layers found in SD file")
+            layer = self.gcode.get_int('LAYER', params, minval=0,
+                                       maxval=index.get_layer_count() - 1)
+            line_num, offset, state = index.find_layer(layer)
+        elif 'LINE' in params:
+            line = self.gcode.get_int('LINE', params, minval=1,
+                                      maxval=index.line_count)
+            line_num, offset, state = index.find_line(line - 1)
+            line_num, offset, state = self.worker_pool.run(
+                sdcard_index.scan_to_line, self.current_file.name,
+                line_num, offset, state, line - 1, self.checkpoints)
+        else:
+            raise self.gcode.error("SDCARD_RESUME requires LINE or LAYER")
+        self.gcode.respond_info("Resuming SD print at line %d (position %d)"
+                                % (line_num + 1, offset))
+        self.gcode.run_script_from_command(
+            state.get_restore_script(self.resume_z_lift))
+        self.file_position = offset
+        self.cmd_M24(params)
     def cmd_M27(self, params):
         # Report SD print status
         if self.current_file is None or self.work_timer is None:
             self.gcode.respond("Not SD printing.")
             return
+        if not self.file_size:
+            self.gcode.respond("SD printing byte %d/%d" % (
+                self.raw_position, self.raw_size))
+            return
         self.gcode.respond("SD printing byte %d/%d" % (
             self.file_position, self.file_size))
     # Background work timer
+    def _skip_done_lines(self, batch):
+        # Advance past the commands of a failed batch that did complete
+        done = batch[:self.gcode.batch_done_count]
+        self.file_position += sum([len(l) for l in done]) + len(done)
     def work_handler(self, eventtime):
         self.logger.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            self.logger.exception("virtual_sdcard seek")
-            self.gcode.respond_error("Unable to seek file")
-            self.work_timer = None
-            return self.reactor.NEVER
+        self.read_ahead = read_ahead = FileReadAhead(
+            self.current_file.name, self.file_position, self.checkpoints)
         partial_input = ""
         lines = []
+        is_move_batch_line = self.gcode.is_move_batch_line
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = read_ahead.get_nowait()
+                    if data is None:
+                        data = self.worker_pool.run(read_ahead.get)
+                    self.raw_position = read_ahead.raw_pos
                 except:
                     self.logger.exception("virtual_sdcard read")
                     self.gcode.respond_error("Error on virtual sdcard read")
@@ -180,7 +445,7 @@ class VirtualSD:
                 if not data:
                     # End of file
                     self.current_file.close()
-                    self.current_file = None
+                    self.current_file = self.checkpoints = None
                     self.logger.info("Finished SD card print")
                     self.gcode.respond("Done printing file")
                     for cb in self.done_cb:
@@ -191,20 +456,33 @@ class VirtualSD:
                 partial_input = lines.pop()
                 lines.reverse()
                 continue
-            # Dispatch command
+            # Dispatch command (a run of moves is dispatched as one batch)
+            count = 1
+            if is_move_batch_line(lines[-1]):
+                max_count = min(len(lines), MOVE_BATCH_LINES)
+                while (count < max_count
+                       and is_move_batch_line(lines[-count-1])):
+                    count += 1
+            batch = lines[-count:]
+            batch.reverse()
             try:
-                res = self.gcode.process_batch(lines[-1])
+                res = self.gcode.process_batch(batch)
                 if not res:
                     self.reactor.pause(self.reactor.monotonic() + 0.100)
                     continue
             except self.gcode.error as e:
+                self._skip_done_lines(batch)
                 for cb in self.done_cb:
                     cb('error')
                 break
             except:
                 self.logger.exception("virtual_sdcard dispatch")
+                self._skip_done_lines(batch)
                 break
-            self.file_position += len(lines.pop()) + 1
+            self.file_position += sum([len(l) for l in batch]) + count
+            del lines[-count:]
+        read_ahead.stop()
+        self.read_ahead = None
         self.logger.info("Exiting SD card print (position %d)",
                          self.file_position)
         self.work_timer = None
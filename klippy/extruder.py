@@ -3,7 +3,7 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math
+import math, bisect
 import stepper, homing, chelper
 
 EXTRUDE_DIFF_IGNORE = 1.02
@@ -133,36 +133,69 @@ class PrinterExtruder:
         if not self.pressure_advance or not lookahead_t:
             return flush_count
         # Calculate max_corner_v - the speed the head will accelerate
-        # to after cornering.
+        # to after cornering.  A decelerating move and any full decel
+        # moves directly after it all look ahead over the same window
+        # of moves, so that window is only scanned once.  The running
+        # max_corner_v is recorded at each step and every move of the
+        # group picks the first value that reaches its own cruise_v.
+        window = moves[:flush_count]
+        max_start_v2 = [m.max_start_v2 for m in window]
+        move_cruise_v = [m.cruise_v for m in window]
+        move_t = [m.accel_t + m.cruise_t + m.decel_t for m in window]
+        group_end = 0
         for i in range(flush_count):
             move = moves[i]
             if not move.decel_t:
                 continue
-            cruise_v = move.cruise_v
-            max_corner_v = 0.
-            sum_t = lookahead_t
-            for j in range(i+1, flush_count):
-                fmove = moves[j]
-                if not fmove.max_start_v2:
-                    break
-                if fmove.cruise_v > max_corner_v:
-                    if (not max_corner_v
-                        and not fmove.accel_t and not fmove.cruise_t):
-                        # Start timing after any full decel moves
-                        continue
-                    if sum_t >= fmove.accel_t:
-                        max_corner_v = fmove.cruise_v
-                    else:
-                        max_corner_v = max(
-                            max_corner_v, fmove.start_v + fmove.accel * sum_t)
-                    if max_corner_v >= cruise_v:
+            if i >= group_end:
+                # Skip full decel moves (timing starts after them)
+                max_cruise_v = move.cruise_v
+                j = i + 1
+                while j < flush_count:
+                    fmove = moves[j]
+                    if (not fmove.max_start_v2 or fmove.accel_t
+                        or fmove.cruise_t or not fmove.cruise_v > 0.):
                         break
-                sum_t -= fmove.accel_t + fmove.cruise_t + fmove.decel_t
-                if sum_t <= 0.:
-                    break
-            else:
-                if lazy:
-                    return i
+                    max_cruise_v = max(max_cruise_v, fmove.cruise_v)
+                    j += 1
+                group_end = j
+                # Scan the window until the fastest move of the group
+                # has reached its cruise speed
+                corner_v = []
+                max_corner_v = 0.
+                sum_t = lookahead_t
+                exhausted = False
+                while 1:
+                    if j >= flush_count:
+                        exhausted = True
+                        break
+                    if not max_start_v2[j]:
+                        break
+                    if move_cruise_v[j] > max_corner_v:
+                        fmove = moves[j]
+                        if (not max_corner_v
+                            and not fmove.accel_t and not fmove.cruise_t):
+                            j += 1
+                            continue
+                        if sum_t >= fmove.accel_t:
+                            max_corner_v = fmove.cruise_v
+                        else:
+                            max_corner_v = max(
+                                max_corner_v,
+                                fmove.start_v + fmove.accel * sum_t)
+                        corner_v.append(max_corner_v)
+                        if max_corner_v >= max_cruise_v:
+                            break
+                    sum_t -= move_t[j]
+                    j += 1
+                    if sum_t <= 0.:
+                        break
+            if corner_v and corner_v[-1] >= move.cruise_v:
+                move.extrude_max_corner_v = corner_v[
+                    bisect.bisect_left(corner_v, move.cruise_v)]
+                continue
+            if exhausted and lazy:
+                return i
             move.extrude_max_corner_v = max_corner_v
         return flush_count
     def move(self, print_time, move):
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, collections
+import sys, os, re, collections
 import homing, extruder, heater
 
 class error(Exception):
@@ -48,6 +48,9 @@ class GCodeParser:
         self.homing_position = [0.0, 0.0, 0.0, 0.0]
         self.speed_factor = 1. / 60.
         self.move_transform = self.move_with_transform = None
+        self.move_batch_with_transform = None
+        self.move_batch = None
+        self.batch_line = self.batch_done_count = 0
         self.position_with_transform = (lambda: [0., 0., 0., 0.])
         # G-Code state
         self.need_ack = False
@@ -68,8 +71,10 @@ class GCodeParser:
         #if cmd in self.ready_gcode_handlers:
         #    raise error("gcode command %s already registered" % (cmd,))
         if not (len(cmd) >= 2 and not cmd[0].isupper() and cmd[1].isdigit()):
-            origfunc = func
-            func = lambda params: origfunc(self.get_extended_params(params))
+            if not self.is_traditional_gcode(cmd):
+                # Only "extended" commands use NAME=value parameters
+                origfunc = func
+                func = lambda params: origfunc(self.get_extended_params(params))
         else:
             raise self.printer.config_error("GCode must be is capitals! cmd: %s" % cmd)
         self.ready_gcode_handlers[cmd] = func
@@ -98,6 +103,8 @@ class GCodeParser:
                 "G-Code move transform already specified")
         self.move_transform = transform
         self.move_with_transform = transform.move
+        self.move_batch_with_transform = getattr(
+            transform, 'move_batch', self._move_batch_fallback)
         self.position_with_transform = transform.get_position
     def stats(self, eventtime):
         return False, "gcodein=%d" % (self.bytes_read,)
@@ -126,6 +133,7 @@ class GCodeParser:
         self.toolhead = self.printer.lookup_object('toolhead')
         if self.move_transform is None:
             self.move_with_transform = self.toolhead.move
+            self.move_batch_with_transform = self.toolhead.move_batch
             self.position_with_transform = self.toolhead.get_position
         self.extruder = self.printer.extruder_get(0)
         if self.extruder is not None:
@@ -168,43 +176,137 @@ class GCodeParser:
         self.logger.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
-    def process_commands(self, commands, need_ack=True):
-        for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
+    number_chars = '0123456789.+-'
+    def is_traditional_gcode(self, cmd):
+        # A "traditional" command is a letter followed by a number (G1, M104)
+        return len(cmd) >= 2 and 'A' <= cmd[0] <= 'Z' and cmd[1:].isdigit()
+    def parse_line(self, line):
+        # Ignore comments and leading/trailing spaces
+        line = origline = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        line = line.upper()
+        # Fast path - every word is a single letter followed by a number
+        words = line.split()
+        params = {}
+        number_chars = self.number_chars
+        for word in words:
+            if not 'A' <= word[0] <= 'Z' or word[1:].lstrip(number_chars):
+                break
+            params[word[0]] = word[1:]
+        else:
             params['#original'] = origline
-            if parts and parts[0] == 'N':
+            if words and words[0][0] == 'N':
                 # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
+                del words[0]
+            params['#command'] = words[0] if words else ''
+            return params
+        # Break command into parts
+        parts = self.args_r.split(line)[1:]
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(0, len(parts), 2) }
+        params['#original'] = origline
+        if parts and parts[0] == 'N':
+            # Skip line number at start of command
+            del parts[:2]
+        if not parts:
+            # Treat empty line as empty command
+            parts = ['', '']
+        params['#command'] = parts[0] + parts[1].strip()
+        return params
+    # Commands that do not interrupt a move batch (empty lines and
+    # comments have no command)
+    move_batch_commands = {'G0': 1, 'G1': 1, 'G00': 1, 'G01': 1, '': 1}
+    move_batch_r = re.compile(
+        '^\s*(?:[nN][0-9]+\s*)?(?:[gG]0?[01](?![0-9.])|;|$)')
+    def is_move_batch_line(self, line):
+        # Check if a line is a move, comment, or empty line (without
+        # fully parsing it)
+        return self.move_batch_r.match(line) is not None
+    def _move_batch_fallback(self, positions, speeds):
+        # Same result as ToolHead.move_batch() for transforms without
+        # a move_batch() method
+        i = 0
+        try:
+            for i, (newpos, speed) in enumerate(zip(positions, speeds)):
+                self.move_with_transform(newpos, speed)
+        except:
+            return i, sys.exc_info()
+        return len(positions), None
+    def _raise_exc_info(self, exc_type, exc_value, tb):
+        raise exc_type, exc_value, tb
+    def flush_move_batch(self):
+        # Queue the batched moves - an error is reported under the
+        # command of the move that failed
+        move_batch = self.move_batch
+        if not move_batch:
+            return
+        positions, speeds, lines, cmds = zip(*move_batch)
+        del move_batch[:]
+        count, exc_info = self.move_batch_with_transform(positions, speeds)
+        if exc_info is None:
+            self.batch_done_count = lines[-1] + 1
+            return
+        self.batch_done_count = lines[count]
+        if isinstance(exc_info[1], homing.EndstopError):
+            exc_info = (error, error(str(exc_info[1])), exc_info[2])
+        self._invoke_handler(cmds[count], self._raise_exc_info, exc_info,
+                             self.need_ack)
+    def process_commands(self, commands, need_ack=True, batch_moves=False):
+        # With batch_moves, consecutive moves are queued as one batch and
+        # batch_done_count tracks the number of commands completed (a
+        # batched move completes once its batch is queued)
+        prev_move_batch = self.move_batch
+        self.move_batch = [] if batch_moves else None
+        try:
+            self._process_commands(commands, need_ack)
+        finally:
+            self.move_batch = prev_move_batch
+    def _process_commands(self, commands, need_ack):
+        move_batch = self.move_batch
+        for i, line in enumerate(commands):
+            params = self.parse_line(line)
+            cmd = params['#command']
             # Invoke handler for command
             self.need_ack = need_ack
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(params)
-            except error as e:
-                self.respond_error(str(e))
-                self.reset_last_position()
-                if not need_ack:
-                    raise
-            except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                self.logger.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self.respond_stop(msg)
-                if not need_ack:
-                    raise
+            if not move_batch:
+                self._invoke_handler(cmd, handler, (params,), need_ack)
+            elif cmd not in self.move_batch_commands:
+                self.flush_move_batch()
+                self._invoke_handler(cmd, handler, (params,), need_ack)
+            else:
+                self.batch_line = i
+                try:
+                    handler(params)
+                except:
+                    # Moves batched before this line are still performed
+                    exc_info = sys.exc_info()
+                    self.flush_move_batch()
+                    self._invoke_handler(cmd, self._raise_exc_info, exc_info,
+                                         need_ack)
             self.ack()
+            if move_batch is not None and not move_batch:
+                self.batch_done_count = i + 1
+        if move_batch:
+            self.flush_move_batch()
+            self.batch_done_count = len(commands)
+    def _invoke_handler(self, cmd, handler, args, need_ack):
+        try:
+            handler(*args)
+        except error as e:
+            self.respond_error(str(e))
+            self.reset_last_position()
+            if not need_ack:
+                raise
+        except:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            self.logger.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self.respond_stop(msg)
+            if not need_ack:
+                raise
     m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
     def process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
@@ -249,12 +351,13 @@ class GCodeParser:
             pending_commands = self.pending_commands
         if self.fd_handle is None:
             self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
-    def process_batch(self, command):
+    def process_batch(self, commands):
         if self.is_processing_data:
             return False
         self.is_processing_data = True
+        self.batch_done_count = 0
         try:
-            self.process_commands([command], need_ack=False)
+            self.process_commands(commands, need_ack=False, batch_moves=True)
         finally:
             if self.pending_commands:
                 self.process_pending()
@@ -271,7 +374,7 @@ class GCodeParser:
         for line in script.split('\n'):
             while 1:
                 try:
-                    res = self.process_batch(line)
+                    res = self.process_batch([line])
                 except:
                     break
                 if res:
@@ -415,21 +518,24 @@ class GCodeParser:
             if temp > 0.:
                 self.respond_error("Heater not configured")
             return
-        print_time = self.toolhead.get_last_move_time()
         try:
-            heater.set_temp(print_time, temp)
+            heater.check_temp(temp)
         except heater.error as e:
             raise error(str(e))
         if wait and temp and self.simulate_print is False:
+            heater.set_temp(self.toolhead.get_last_move_time(), temp)
             self.bg_temp(heater)
+            return
+        self.toolhead.register_lookahead_callback(
+            (lambda print_time: heater.set_temp(print_time, temp)))
     def set_fan_speed(self, speed, index):
         fan = self.printer.lookup_object('fan %d' % (index,), None)
         if fan is None:
             if speed and not self.is_fileinput:
                 self.respond_info("Fan not configured")
             return
-        print_time = self.toolhead.get_last_move_time()
-        fan.set_speed(print_time, speed)
+        self.toolhead.register_lookahead_callback(
+            (lambda print_time: fan.set_speed(print_time, speed)))
     # G-Code special command handlers
     def cmd_default(self, params):
         if not self.is_printer_ready:
@@ -483,7 +589,7 @@ class GCodeParser:
         'M112', 'M115', 'IGNORE', 'QUERY_ENDSTOPS', 'GET_POSITION',
         'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
     # G-Code movement commands
-    cmd_G1_aliases = ['G0']
+    cmd_G1_aliases = ['G0', 'G00', 'G01']
     def cmd_G1(self, params):
         # Move
         try:
@@ -516,6 +622,11 @@ class GCodeParser:
                 self.speed = speed
         except ValueError as e:
             raise error("Unable to parse move '%s'" % (params['#original'],))
+        if self.move_batch is not None:
+            # Submitted later by flush_move_batch()
+            self.move_batch.append((list(self.last_position), self.speed,
+                                    self.batch_line, params['#command']))
+            return
         try:
             self.move_with_transform(self.last_position, self.speed)
         except homing.EndstopError as e:
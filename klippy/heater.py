@@ -292,10 +292,12 @@ class PrinterHeater:
         return self.report_delta
     def get_max_power(self):
         return self.max_power
-    def set_temp(self, print_time, degrees, auto_tune=False):
+    def check_temp(self, degrees):
         if degrees and (degrees < self.min_temp or degrees > self.max_temp):
             raise error("Requested temperature (%.1f) out of range (%.1f:%.1f)"
                         % (degrees, self.min_temp, self.max_temp))
+    def set_temp(self, print_time, degrees, auto_tune=False):
+        self.check_temp(degrees)
         self.protect_runaway_disabled = auto_tune
         with self.lock:
             self.target_temp = degrees
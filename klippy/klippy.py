@@ -145,6 +145,7 @@ class Printer:
         self.reactor = reactor.Reactor()
         gc = gcode.GCodeParser(self, input_fd)
         self.objects = collections.OrderedDict({'gcode': gc})
+        self.objects['worker_pool'] = self.reactor.get_worker_pool()
         self.stats_timer = self.reactor.register_timer(self._stats)
         self.connect_timer = self.reactor.register_timer(
             self._connect, self.reactor.NOW)
@@ -294,19 +295,40 @@ class Printer:
                          if hasattr(o, 'stats')]
         self.state_cb = [o.printer_state for o in self.objects.values()
                          if hasattr(o, 'printer_state')]
+    def _connect_mcus(self):
+        # The first mcu (in section name order) has the main clock sync
+        # that the other mcus calibrate against (see
+        # mcu.add_printer_objects()), so its clock sync is started before
+        # the remaining micro-controllers are connected in parallel
+        mcus = [self.objects[name] for name in sorted(self.objects)
+                if isinstance(self.objects[name], mcu.MCU)]
+        if not mcus:
+            return mcus
+        main_mcu = mcus[0]
+        main_mcu.connect_clock()
+        jobs = [self.reactor.spawn(main_mcu.connect_config)]
+        jobs.extend([self.reactor.spawn(m.printer_state, 'connect')
+                     for m in mcus[1:]])
+        self.reactor.wait_jobs(jobs)
+        return mcus
     def _connect(self, eventtime):
         self.reactor.unregister_timer(self.connect_timer)
         try:
             self._read_config()
+            mcus = self._connect_mcus()
             for cb in self.state_cb:
                 if self.state_message is not message_startup:
                     return self.reactor.NEVER
+                if cb.im_self in mcus:
+                    continue
                 cb('connect')
             self._set_state(message_ready)
             for cb in self.state_cb:
                 if self.state_message is not message_ready:
                     return self.reactor.NEVER
                 cb('ready')
+            self.logger.info("Printer ready in %.3fs (%d mcus)",
+                             self.reactor.monotonic() - eventtime, len(mcus))
             if self.start_args.get('debugoutput') is None:
                 self.reactor.update_timer(self.stats_timer, self.reactor.NOW)
         except (self.config_error, pins.error) as e:
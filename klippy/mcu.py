@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, zlib, math, time
+import os, zlib, math
 import serialhdl, pins, chelper, clocksync
 
 class error(Exception):
@@ -399,6 +399,12 @@ class MCU_adc:
         if self._callback is not None:
             self._callback(last_read_time, last_value)
 
+# Encoded config commands (kept across printer restarts) - keyed by the
+# config crc (which the mcu also uses to identify its config) and the
+# mcu data dictionary the commands were encoded with
+encoded_config_cache = {}
+ENCODED_CONFIG_CACHE_SIZE = 8
+
 class MCU:
     error = error
     def __init__(self, printer, config, clocksync):
@@ -416,9 +422,14 @@ class MCU:
         if (self._serialport.startswith("/dev/rpmsg_")
             or self._serialport.startswith("/tmp/klipper_host_")):
             baud = 0
+        dictionary_cache = config.get('dictionary_cache',
+                                      '~/.klipper/dictionary_cache')
+        if not dictionary_cache:
+            dictionary_cache = None
         self._serial = serialhdl.SerialReader(
             self._reactor, self._serialport, baud,
-            logger=self.logger.getChild('serial'))
+            logger=self.logger.getChild('serial'),
+            dictionary_cache=dictionary_cache)
         # Restarts
         rmethods = {m: m for m in [None, 'arduino', 'command', 'rpi_usb']}
         self._restart_method = config.getchoice('restart_method',
@@ -437,9 +448,11 @@ class MCU:
         self._init_cmds = []
         self._config_cmds = []
         self._config_crc = None
+        self._config_upload_info = ""
         self._pin_map = config.get('pin_map', None)
         self._custom = config.get('custom', '')
         self._mcu_freq = 0.
+        self._connect_time = 0.
         # Move command queuing
         ffi_main, self._ffi_lib = chelper.get_ffi()
         self._max_stepper_error = config.getfloat(
@@ -532,6 +545,17 @@ class MCU:
         # Calculate config CRC
         self._config_crc = zlib.crc32('\n'.join(self._config_cmds)) & 0xffffffff
         self.add_config_cmd("finalize_config crc=%d" % (self._config_crc,))
+    def _encode_config(self):
+        # Encode the config commands (reusing a previous encoding if the
+        # config and data dictionary are unchanged)
+        key = (self._config_crc, self._serial.msgparser.raw_identify_data)
+        batch = encoded_config_cache.get(key)
+        if batch is None:
+            if len(encoded_config_cache) >= ENCODED_CONFIG_CACHE_SIZE:
+                encoded_config_cache.clear()
+            batch = self._serial.encode_batch(self._config_cmds)
+            encoded_config_cache[key] = batch
+        return batch
     def _send_config(self):
         get_config_cmd = self.lookup_command("get_config")
         if self.is_fileoutput():
@@ -546,8 +570,9 @@ class MCU:
             # Send config commands
             self.logger.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            send_time = self._reactor.monotonic()
+            batch = self._encode_config()
+            self._serial.send_batch(batch)
             if not self.is_fileoutput():
                 config_params = get_config_cmd.send_with_response(
                     response='config')
@@ -556,6 +581,11 @@ class MCU:
                         raise error("MCU '%s' error during config: %s" % (
                             self._name, self._shutdown_msg))
                     raise error("Unable to configure MCU '%s'" % (self._name,))
+            self._config_upload_info = (
+                "MCU '%s' config upload: %d commands %d bytes in %.3fs" % (
+                    self._name, len(batch[1]), len(batch[0]),
+                    self._reactor.monotonic() - send_time))
+            self.logger.info(self._config_upload_info)
         else:
             start_reason = self._printer.get_start_args().get("start_reason")
             if start_reason == 'firmware_restart':
@@ -575,14 +605,17 @@ class MCU:
                 msgparser.version, msgparser.build_versions),
             "MCU '%s' config: %s" % (self._name, " ".join(
                 ["%s=%s" % (k, v) for k, v in msgparser.config.items()]))]
+        if self._config_upload_info:
+            info.append(self._config_upload_info)
         self._printer.set_rollover_info(self._name, "\n".join(info))
         self._steppersync = self._ffi_lib.steppersync_alloc(
             self._serial.serialqueue, self._stepqueues, len(self._stepqueues),
             move_count)
         self._ffi_lib.steppersync_set_time(self._steppersync, 0., self._mcu_freq)
-        for c in self._init_cmds:
-            self._serial.send(c)
-    def _connect(self):
+        self._serial.send_batch(self._serial.encode_batch(self._init_cmds))
+    def connect_clock(self):
+        # Open the connection and start the clock synchronization
+        self._connect_time = self._reactor.monotonic()
         if self.is_fileoutput():
             self._connect_file()
         else:
@@ -592,6 +625,8 @@ class MCU:
                 self._check_restart("enable power")
             self._serial.connect()
             self._clocksync.connect(self._serial)
+    def connect_config(self):
+        # Configure the micro-controller (after connect_clock())
         self._mcu_freq = self.get_constant_float('CLOCK_FREQ')
         self._stats_sumsq_base = self.get_constant_float('STATS_SUMSQ_BASE')
         self._emergency_stop_cmd = self.lookup_command("emergency_stop")
@@ -608,7 +643,11 @@ class MCU:
         self.register_msg(self.handle_mcu_stats, 'stats')
         self._build_config()
         self._send_config()
-        time.sleep(1) # give a little delay to receive shutdown
+        # give a little delay to receive shutdown
+        self._reactor.pause(self._reactor.monotonic() + 1.)
+        self.logger.info("MCU '%s' connected and configured in %.3fs",
+                         self._name,
+                         self._reactor.monotonic() - self._connect_time)
     # Config creation helpers
     def setup_pin(self, pin_params):
         pcs = {'stepper': MCU_stepper, 'endstop': MCU_endstop,
@@ -752,7 +791,8 @@ class MCU:
                                 self._clocksync.stats(eventtime)])
     def printer_state(self, state):
         if state == 'connect':
-            self._connect()
+            self.connect_clock()
+            self.connect_config()
         elif state == 'disconnect':
             self._disconnect()
         elif state == 'shutdown':
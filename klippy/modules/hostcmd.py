@@ -23,6 +23,7 @@ class Command(object):
     def __init__(self, gcode, name, command):
         self.logger = gcode.logger.getChild(name)
         self.gcode = gcode
+        self.worker_pool = gcode.printer.get_reactor().get_worker_pool()
         self.command = command
         name = "HOST_CMD_" + name
         gcode.register_command(
@@ -31,8 +32,11 @@ class Command(object):
         self.logger.debug("ALIAS %s : %s registered" % (name, command))
     def execute(self, params):
         self.logger.debug("command %s executed" % self.command)
-        msg = os.popen(self.command).read()
+        # Run the command in a worker thread so it can't stall the reactor
+        msg = self.worker_pool.run(self._run_command)
         self.gcode.respond_info(msg)
+    def _run_command(self):
+        return os.popen(self.command).read()
 
 def load_config(config):
     return HostCmd(config)
@@ -46,6 +46,7 @@ Status info:
 
 import time, sys, os, errno, threading, json, re, logging
 import util
+from extras import sdcard_file
 
 try:
     sys.path.append(os.path.normpath(
@@ -180,7 +181,7 @@ def analyse_gcode_file(filepath):
     absolutecoord = True
     last_position = .0
     try:
-        with open(filepath, 'rb') as f:
+        with sdcard_file.open_file(filepath) as f:
             #f.seek(0, os.SEEK_END)
             #fsize = f.tell()
             f.seek(0)
@@ -556,7 +557,7 @@ class rrHandler(tornado.web.RequestHandler):
                         data = {
                             "type" : "f",
                             "name" : os.path.relpath(filepath, path),
-                            "size" : os.path.getsize(filepath),
+                            "size" : sdcard_file.get_listed_size(filepath),
                             "date" : time.strftime("%Y-%m-%dT%H:%M:%S",
                                                    time.gmtime(os.path.getmtime(filepath))),
                         }
@@ -617,7 +618,7 @@ class rrHandler(tornado.web.RequestHandler):
             else:
                 info = analyse_gcode_file(path)
                 respdata["err"] = 0
-                respdata["size"] = os.path.getsize(path)
+                respdata["size"] = sdcard_file.get_listed_size(path)
                 respdata["lastModified"] = \
                     time.strftime("%Y-%m-%dT%H:%M:%S",
                                   time.gmtime(os.path.getmtime(path)))
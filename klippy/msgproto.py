@@ -22,20 +22,80 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+MESSAGE_SYNC_BYTE = 0x7E
 
 class error(Exception):
     pass
 
-def crc16_ccitt(buf):
-    crc = 0xffff
-    for data in buf:
-        data = ord(data)
-        data ^= crc & 0xff
+# Table driven crc16 (one entry for each value of the low crc byte
+# xor'ed with the next data byte)
+def _build_crc16_table():
+    table = []
+    for data in range(256):
         data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
-    crc = chr(crc >> 8) + chr(crc & 0xff)
+        table.append((data << 8) ^ (data >> 4) ^ (data << 3))
+    return table
+CRC16_TABLE = _build_crc16_table()
+
+# Update a crc16 with the data in buf[start:end] of a bytearray (the
+# bounds avoid copying a message out of a larger buffer)
+def crc16_update(buf, crc=0xffff, start=0, end=None):
+    table = CRC16_TABLE
+    if end is None:
+        end = len(buf)
+    for i in xrange(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xff]
     return crc
 
+def crc16_ccitt(buf):
+    if not isinstance(buf, bytearray):
+        buf = bytearray(buf)
+    crc = crc16_update(buf)
+    return chr(crc >> 8) + chr(crc & 0xff)
+
+# Framing helpers - these work on a bytearray at an offset so that large
+# buffers (eg, serial captures) do not need to be sliced for each message
+
+# Check for a message at 'pos' of 'buf'.  Returns the message length, 0
+# if more data is needed, or -1 if the data is not a valid message.
+def check_frame(buf, pos=0):
+    if len(buf) - pos < MESSAGE_MIN:
+        return 0
+    msglen = buf[pos + MESSAGE_POS_LEN]
+    if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
+        return -1
+    msgseq = buf[pos + MESSAGE_POS_SEQ]
+    if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
+        return -1
+    if len(buf) - pos < msglen:
+        # Need more data
+        return 0
+    end = pos + msglen
+    if buf[end - MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC_BYTE:
+        return -1
+    crc = crc16_update(buf, 0xffff, pos, end - MESSAGE_TRAILER_SIZE)
+    crcpos = end - MESSAGE_TRAILER_CRC
+    if buf[crcpos] != crc >> 8 or buf[crcpos + 1] != crc & 0xff:
+        return -1
+    return msglen
+
+# Locate the messages in 'buf' starting at 'pos'.  Returns a list of
+# (position, length) tuples, the number of invalid bytes skipped, and
+# the position of the remaining (incomplete) data.
+def split_frames(buf, pos=0):
+    frames = []
+    invalid = 0
+    while 1:
+        msglen = check_frame(buf, pos)
+        if msglen > 0:
+            frames.append((pos, msglen))
+            pos += msglen
+        elif msglen < 0:
+            invalid += 1
+            pos += 1
+        else:
+            return frames, invalid, pos
+
 class PT_uint32:
     is_int = 1
     max_length = 5
@@ -91,6 +151,67 @@ MessageTypes = {
     '%s': PT_string(), '%.*s': PT_progmem_buffer(), '%*s': PT_buffer(),
 }
 
+# Generate specialized encode and parse functions for a message format
+# (equivalent to MessageFormat.encode/encode_by_name/parse but without
+# the per parameter method calls)
+ENCODE_INT = """
+    v = %s
+    if v >= 0x60 or v < -0x20:
+        if v >= 0x3000 or v < -0x1000:
+            if v >= 0x180000 or v < -0x80000:
+                if v >= 0xc000000 or v < -0x4000000:
+                    append((v>>28) & 0x7f | 0x80)
+                append((v>>21) & 0x7f | 0x80)
+            append((v>>14) & 0x7f | 0x80)
+        append((v>>7) & 0x7f | 0x80)
+    append(v & 0x7f)"""
+ENCODE_STRING = """
+    v = %s
+    append(len(v))
+    out.extend(bytearray(v))"""
+PARSE_INT = """
+    c = s[pos]
+    pos += 1
+    if c < 0x60:
+        p%d = c
+    else:
+        v = c & 0x7f
+        if (c & 0x60) == 0x60:
+            v |= -0x20
+        while c & 0x80:
+            c = s[pos]
+            pos += 1
+            v = (v<<7) | (c & 0x7f)
+        p%d = %s"""
+PARSE_STRING = """
+    l = s[pos]
+    p%d = str(bytearray(s[pos+1:pos+l+1]))
+    pos += l+1"""
+
+def compile_format(msgid, param_names):
+    encode = ["def encode(params):"]
+    encode_by_name = ["def encode_by_name(**params):"]
+    for code in [encode, encode_by_name]:
+        code.append("    out = [%d]\n    append = out.append" % (msgid,))
+    parse = ["def parse(s, pos):\n    pos += 1"]
+    for i, (name, t) in enumerate(param_names):
+        if t.is_int:
+            encode.append(ENCODE_INT % ("params[%d]" % (i,),))
+            encode_by_name.append(ENCODE_INT % ("params[%r]" % (name,),))
+            parse.append(PARSE_INT % (
+                i, i, "v" if t.signed else "int(v & 0xffffffff)"))
+        else:
+            encode.append(ENCODE_STRING % ("params[%d]" % (i,),))
+            encode_by_name.append(ENCODE_STRING % ("params[%r]" % (name,),))
+            parse.append(PARSE_STRING % (i,))
+    for code in [encode, encode_by_name]:
+        code.append("    return out")
+    parse.append("    return {%s}, pos" % (", ".join([
+        "%r: p%d" % (name, i) for i, (name, t) in enumerate(param_names)]),))
+    funcs = {}
+    exec "\n".join(encode + encode_by_name + parse) in funcs
+    return funcs['encode'], funcs['encode_by_name'], funcs['parse']
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     mf = msgformat.replace('%c', '%u')
@@ -108,19 +229,25 @@ class MessageFormat:
         self.param_types = [MessageTypes[fmt] for name, fmt in argparts]
         self.param_names = [(name, MessageTypes[fmt]) for name, fmt in argparts]
         self.name_to_type = dict(self.param_names)
-    def encode(self, params):
+        # Specialized encode(), encode_by_name(), and parse() for this
+        # format
+        self.encode, self.encode_by_name, self.parse = compile_format(
+            msgid, self.param_names)
+    # Generic (per parameter type) versions of the compiled functions -
+    # the reference they are checked against (see scripts/msgproto_fuzz.py)
+    def encode_ref(self, params):
         out = []
         out.append(self.msgid)
         for i, t in enumerate(self.param_types):
             t.encode(out, params[i])
         return out
-    def encode_by_name(self, **params):
+    def encode_by_name_ref(self, **params):
         out = []
         out.append(self.msgid)
         for name, t in self.param_names:
             t.encode(out, params[name])
         return out
-    def parse(self, s, pos):
+    def parse_ref(self, s, pos):
         pos += 1
         out = {}
         for name, t in self.param_names:
@@ -192,36 +319,23 @@ class MessageParser:
         self.raw_identify_data = ""
         self._init_messages(DefaultMessages, DefaultMessages.keys())
     def check_packet(self, s):
-        if len(s) < MESSAGE_MIN:
-            return 0
-        msglen = ord(s[MESSAGE_POS_LEN])
-        if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
-            return -1
-        msgseq = ord(s[MESSAGE_POS_SEQ])
-        if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
-            return -1
-        if len(s) < msglen:
-            # Need more data
-            return 0
-        if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
-            return -1
-        msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
-        if crc != msgcrc:
-            #logging.debug("got crc %s vs %s", repr(crc), repr(msgcrc))
-            return -1
-        return msglen
-    def dump(self, s):
-        msgseq = s[MESSAGE_POS_SEQ]
-        out = ["seq: %02x" % (msgseq,)]
+        return check_frame(bytearray(s[:MESSAGE_MAX]))
+    def iter_commands(self, s):
+        # Generate (format, params, encoded length) for each command
         pos = MESSAGE_HEADER_SIZE
         while 1:
             msgid = s[pos]
             mid = self.messages_by_id.get(msgid, self.unknown)
-            params, pos = mid.parse(s, pos)
-            out.append(mid.format_params(params))
+            params, newpos = mid.parse(s, pos)
+            yield mid, params, newpos - pos
+            pos = newpos
             if pos >= len(s)-MESSAGE_TRAILER_SIZE:
                 break
+    def dump(self, s):
+        msgseq = s[MESSAGE_POS_SEQ]
+        out = ["seq: %02x" % (msgseq,)]
+        for mid, params, length in self.iter_commands(s):
+            out.append(mid.format_params(params))
         return out
     def format_params(self, params):
         name = params.get('#name')
@@ -246,10 +360,11 @@ class MessageParser:
     def encode(self, seq, cmd):
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
-        out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
-        out.append(MESSAGE_SYNC)
-        return ''.join(out)
+        out = bytearray((msglen, seq))
+        out.extend(cmd)
+        crc = crc16_update(out)
+        out.extend((crc >> 8, crc & 0xff, MESSAGE_SYNC_BYTE))
+        return str(out)
     def _parse_buffer(self, value):
         if not value:
             return []
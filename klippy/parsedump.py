@@ -4,42 +4,139 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging
+import sys, logging, optparse, csv
 import msgproto
 
+READ_SIZE = 1024 * 1024
+
 def read_dictionary(filename):
     dfile = open(filename, 'rb')
     dictionary = dfile.read()
     dfile.close()
     return dictionary
 
+# Generate the frames of a dump file as (frame number, bytearray).  The
+# input is read in large chunks into a buffer that only ever holds one
+# chunk plus a partial frame.
+def read_frames(f, stats):
+    data = bytearray()
+    frame_count = 0
+    while 1:
+        newdata = f.read(READ_SIZE)
+        if not newdata:
+            break
+        data.extend(newdata)
+        frames, invalid, pos = msgproto.split_frames(data)
+        for i in range(invalid):
+            logging.error("Invalid data")
+        stats.invalid_bytes += invalid
+        for msgpos, msglen in frames:
+            yield frame_count, data[msgpos:msgpos+msglen]
+            frame_count += 1
+        del data[:pos]
+    stats.trailing_bytes += len(data)
+
+# Generate (frame number, seq, format, params, length) for each command
+# in a dump file
+def decode_stream(mp, f, stats):
+    for frame, msg in read_frames(f, stats):
+        stats.frames += 1
+        stats.frame_bytes += len(msg)
+        seq = msg[msgproto.MESSAGE_POS_SEQ]
+        for mid, params, length in mp.iter_commands(msg):
+            yield frame, seq, mid, params, length
+
+class DumpStats:
+    def __init__(self):
+        self.frames = self.frame_bytes = 0
+        self.invalid_bytes = self.trailing_bytes = 0
+        self.commands = {}
+    def note_command(self, name, length):
+        counts = self.commands.get(name)
+        if counts is None:
+            counts = self.commands[name] = [0, 0]
+        counts[0] += 1
+        counts[1] += length
+    def report(self):
+        out = ["%-32s %10s %12s" % ("message", "count", "bytes")]
+        for name, (count, length) in sorted(
+                self.commands.items(), key=lambda i: -i[1][1]):
+            out.append("%-32s %10d %12d" % (name, count, length))
+        command_bytes = sum([l for c, l in self.commands.values()])
+        out.append("frames=%d frame_bytes=%d command_bytes=%d"
+                   " overhead_bytes=%d invalid_bytes=%d trailing_bytes=%d" % (
+                       self.frames, self.frame_bytes, command_bytes,
+                       self.frame_bytes - command_bytes, self.invalid_bytes,
+                       self.trailing_bytes))
+        return '\n'.join(out)
+
+def write_output(out, csv_writer):
+    if csv_writer is not None:
+        csv_writer.writerows(out)
+    else:
+        sys.stdout.write('\n'.join(out) + '\n')
+
 def main():
-    dict_filename, data_filename = sys.argv[1:]
+    usage = "%prog [options] <dictionary file> <data file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--name", action="append", default=[],
+                    help="only show messages with the given name")
+    opts.add_option("-o", "--oid", action="append", type="int", default=[],
+                    help="only show messages with the given oid")
+    opts.add_option("-s", "--summary", action="store_true",
+                    help="report message counts and sizes")
+    opts.add_option("-c", "--csv", type="string", dest="csv",
+                    help="write the parameters of one message type (see"
+                    " --name) to a csv file")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    if options.summary and options.csv is not None:
+        opts.error("--summary and --csv are mutually exclusive")
+    dict_filename, data_filename = args
+    names = set([n for arg in options.name for n in arg.split(',')])
+    oids = set(options.oid)
 
     dictionary = read_dictionary(dict_filename)
 
     mp = msgproto.MessageParser()
     mp.process_identify(dictionary, decompress=False)
 
+    csv_file = csv_writer = param_names = None
+    if options.csv is not None:
+        if len(names) != 1:
+            opts.error("--csv requires a single --name")
+        mid = mp.messages_by_name.get(list(names)[0])
+        if mid is None:
+            opts.error("Unknown message %s" % (list(names)[0],))
+        param_names = [name for name, t in mid.param_names]
+        csv_file = open(options.csv, 'wb')
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(['frame', 'seq'] + param_names)
+
+    stats = DumpStats()
     f = open(data_filename, 'rb')
-    fd = f.fileno()
-    data = ""
-    while 1:
-        newdata = os.read(fd, 4096)
-        if not newdata:
-            break
-        data += newdata
-        while 1:
-            l = mp.check_packet(data)
-            if l == 0:
-                break
-            if l < 0:
-                logging.error("Invalid data")
-                data = data[-l:]
-                continue
-            msgs = mp.dump(bytearray(data[:l]))
-            sys.stdout.write('\n'.join(msgs[1:]) + '\n')
-            data = data[l:]
+    out = []
+    for frame, seq, mid, params, length in decode_stream(mp, f, stats):
+        if names and mid.name not in names:
+            continue
+        if oids and params.get('oid') not in oids:
+            continue
+        if options.summary:
+            stats.note_command(mid.name, length)
+        elif csv_writer is not None:
+            out.append([frame, seq] + [params[name] for name in param_names])
+        else:
+            out.append(mid.format_params(params))
+        if len(out) >= 10000:
+            write_output(out, csv_writer)
+            out = []
+    if out:
+        write_output(out, csv_writer)
+    if csv_file is not None:
+        csv_file.close()
+    if options.summary:
+        sys.stdout.write(stats.report() + '\n')
 
 if __name__ == '__main__':
     main()
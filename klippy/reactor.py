@@ -3,7 +3,8 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, select, math, time, Queue
+import sys, os, select, math, time, heapq, bisect, struct, collections
+import threading, Queue
 import greenlet
 import chelper, util
 
@@ -11,6 +12,9 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.is_registered = False
+        self.heap_entry = None
+        self.profile_name = None
 
 class ReactorCallback:
     def __init__(self, reactor, callback):
@@ -29,10 +33,197 @@ class ReactorFileHandler:
     def fileno(self):
         return self.fd
 
+# A job run in a worker thread (or in its own greenlet via spawn())
+class ReactorWorkerJob:
+    def __init__(self, func, args, submit_time):
+        self.func = func
+        self.args = args
+        self.submit_time = submit_time
+        self.start_time = self.end_time = 0.
+        self.result = self.exc_info = None
+        self.done = False
+        self.waiting = None
+
+# Pool of threads for blocking operations (file and subprocess I/O).
+# Results are returned to the reactor thread via async callbacks and
+# the greenlet waiting on a job is paused until it completes.
+class ReactorWorkerPool:
+    def __init__(self, reactor, max_workers=4):
+        self.reactor = reactor
+        self.max_workers = max_workers
+        self.job_queue = Queue.Queue()
+        self.workers = []
+        # Accounting (only updated from the reactor thread)
+        self.pending = self.completed = 0
+        self.wait_total = self.run_total = 0.
+        self.interval_pending = 0
+        self.interval_wait = self.interval_run = 0.
+    def _work(self):
+        monotonic = self.reactor.monotonic
+        while 1:
+            job = self.job_queue.get()
+            job.start_time = monotonic()
+            try:
+                job.result = job.func(*job.args)
+            except:
+                job.exc_info = sys.exc_info()
+            job.end_time = monotonic()
+            self.reactor.register_async_callback(
+                (lambda e, job=job: self._complete(job)))
+    def _complete(self, job):
+        job.done = True
+        self.pending -= 1
+        self.completed += 1
+        wait_time = job.start_time - job.submit_time
+        run_time = job.end_time - job.start_time
+        self.wait_total += wait_time
+        self.run_total += run_time
+        self.interval_wait = max(self.interval_wait, wait_time)
+        self.interval_run = max(self.interval_run, run_time)
+        if job.waiting is not None:
+            self.reactor.update_timer(job.waiting.timer, self.reactor.NOW)
+    def submit(self, func, *args):
+        job = ReactorWorkerJob(func, args, self.reactor.monotonic())
+        self.pending += 1
+        self.interval_pending = max(self.interval_pending, self.pending)
+        if (self.pending > len(self.workers)
+            and len(self.workers) < self.max_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.job_queue.put(job)
+        return job
+    def wait(self, job):
+        # Pause the calling greenlet until the job completes
+        return self.reactor.wait_jobs([job])[0]
+    def run(self, func, *args):
+        if self.reactor._g_dispatch is None:
+            # Reactor not running - run the job directly
+            return func(*args)
+        return self.wait(self.submit(func, *args))
+    def stats(self, eventtime):
+        avg_wait = self.wait_total / max(1, self.completed)
+        avg_run = self.run_total / max(1, self.completed)
+        msg = ("worker_jobs=%d worker_pending=%d worker_max_pending=%d"
+               " worker_wait=%.6f/%.6f worker_run=%.6f/%.6f" % (
+                   self.completed, self.pending, self.interval_pending,
+                   avg_wait, self.interval_wait, avg_run, self.interval_run))
+        self.interval_pending = self.pending
+        self.interval_wait = self.interval_run = 0.
+        return False, msg
+
 class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
+        # Time accounting of the callback running in this greenlet
+        self.profile_start = self.profile_elapsed = None
+
+# Optional instrumentation of the time spent in reactor callbacks
+class ReactorProfiler:
+    # Upper bounds (in seconds) of the callback duration histogram
+    BUCKETS = (.0001, .0005, .001, .005, .010, .050, .100)
+    def __init__(self, reactor, warn_time, logger):
+        self.reactor = reactor
+        self.monotonic = reactor.monotonic
+        self.warn_time = warn_time
+        self.logger = logger
+        self.fd_names = {}
+        self.reset()
+    def reset(self):
+        # Per callback name: [count, total time, max time, histogram]
+        self.callbacks = {}
+        self.switches = 0
+        self.lag_count = 0
+        self.lag_total = self.lag_max = 0.
+        self._reset_interval()
+    def _reset_interval(self):
+        self.interval_max = self.interval_lag = 0.
+        self.interval_name = None
+        self.interval_switches = 0
+    def _get_name(self, callback):
+        obj = getattr(callback, '__self__', None)
+        name = getattr(callback, '__name__', type(callback).__name__)
+        if obj is not None:
+            return "%s.%s" % (obj.__class__.__name__, name)
+        return name
+    def _record(self, name, elapsed):
+        stat = self.callbacks.get(name)
+        if stat is None:
+            stat = self.callbacks[name] = [
+                0, 0., 0., [0] * (len(self.BUCKETS) + 1)]
+        stat[0] += 1
+        stat[1] += elapsed
+        if elapsed > stat[2]:
+            stat[2] = elapsed
+        stat[3][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+        if elapsed > self.interval_max:
+            self.interval_max = elapsed
+            self.interval_name = name
+        if elapsed >= self.warn_time:
+            self.logger.warning("Reactor callback %s took %.6fs",
+                                name, elapsed)
+    def invoke(self, name, callback, eventtime, waketime=0.):
+        g = self.reactor._g_dispatch
+        g.profile_elapsed = 0.
+        g.profile_start = start = self.monotonic()
+        if waketime > 0.:
+            # Lag between the requested and actual timer wakeup
+            lag = start - waketime
+            self.lag_count += 1
+            self.lag_total += lag
+            if lag > self.lag_max:
+                self.lag_max = lag
+            if lag > self.interval_lag:
+                self.interval_lag = lag
+        res = callback(eventtime)
+        elapsed = g.profile_elapsed + self.monotonic() - g.profile_start
+        g.profile_start = g.profile_elapsed = None
+        self._record(name, elapsed)
+        return res
+    def invoke_timer(self, t, waketime, eventtime):
+        name = t.profile_name
+        if name is None:
+            name = t.profile_name = self._get_name(t.callback)
+        return self.invoke(name, t.callback, eventtime, waketime)
+    def invoke_fd(self, callback, eventtime):
+        name = self.fd_names.get(callback)
+        if name is None:
+            name = self.fd_names[callback] = self._get_name(callback)
+        return self.invoke(name, callback, eventtime)
+    # Greenlet switches - time spent paused is not charged to a callback
+    def switch_out(self, g):
+        self.switches += 1
+        self.interval_switches += 1
+        self.suspend(g)
+    def suspend(self, g):
+        if g.profile_start is not None:
+            g.profile_elapsed += self.monotonic() - g.profile_start
+            g.profile_start = None
+    def resume(self, g):
+        if g.profile_elapsed is not None:
+            g.profile_start = self.monotonic()
+    def get_interval_stats(self):
+        msg = "reactor_max=%.6f(%s) reactor_lag=%.6f reactor_switches=%d" % (
+            self.interval_max, self.interval_name, self.interval_lag,
+            self.interval_switches)
+        self._reset_interval()
+        return msg
+    def get_report(self, count=20):
+        buckets = ["<%.1fms" % (b * 1000.,) for b in self.BUCKETS] + ["more"]
+        lines = ["Reactor callbacks (histogram buckets: %s)" % (
+            " ".join(buckets),)]
+        stats = sorted(self.callbacks.items(), key=lambda i: -i[1][1])
+        for name, (calls, total, max_time, hist) in stats[:count]:
+            lines.append("%s: count=%d total=%.3f avg=%.6f max=%.6f hist=%s"
+                         % (name, calls, total, total / calls, max_time,
+                            "/".join([str(h) for h in hist])))
+        lag_avg = self.lag_total / max(1, self.lag_count)
+        lines.append("timer lag: count=%d avg=%.6f max=%.6f"
+                     " greenlet switches=%d" % (
+                         self.lag_count, lag_avg, self.lag_max, self.switches))
+        return "\n".join(lines)
 
 class SelectReactor:
     NOW = 0.
@@ -41,49 +232,112 @@ class SelectReactor:
         # Main code
         self._process = False
         self.monotonic = chelper.get_ffi()[1].get_monotonic
-        # Timers
-        self._timers = []
+        # Timers (heap of [waketime, sequence, timer] entries - entries
+        # of updated or unregistered timers are left in the heap with
+        # their timer set to None and are discarded as they are popped)
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_stale = 0
+        self._timer_deferred = []
         self._next_timer = self.NEVER
-        # Callbacks
+        # Callbacks (the async queue is filled from other threads - a
+        # wakeup is only signaled when the queue is not already pending)
         self._pipe_fds = None
-        self._async_queue = Queue.Queue()
+        self._async_queue = collections.deque()
+        self._async_pending = False
         # File descriptors
         self._fds = []
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
+        # Profiling
+        self._profiler = None
+        # Worker threads
+        self._worker_pool = None
     # Timers
-    def _note_time(self, t):
-        nexttime = t.waketime
-        if nexttime < self._next_timer:
-            self._next_timer = nexttime
+    def _cancel_timer(self, t):
+        entry = t.heap_entry
+        if entry is not None:
+            entry[2] = None
+            t.heap_entry = None
+            self._timer_stale += 1
+    def _schedule_timer(self, t):
+        self._cancel_timer(t)
+        waketime = t.waketime
+        if waketime >= self.NEVER:
+            return
+        self._timer_seq += 1
+        t.heap_entry = entry = [waketime, self._timer_seq, t]
+        heapq.heappush(self._timer_heap, entry)
+        if waketime < self._next_timer:
+            self._next_timer = waketime
     def update_timer(self, t, nexttime):
         t.waketime = nexttime
-        self._note_time(t)
+        if t.is_registered:
+            self._schedule_timer(t)
     def register_timer(self, callback, waketime = NEVER):
         handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(handler)
-        self._timers = timers
-        self._note_time(handler)
+        handler.is_registered = True
+        self._schedule_timer(handler)
         return handler
     def unregister_timer(self, handler):
-        timers = list(self._timers)
-        timers.pop(timers.index(handler))
-        self._timers = timers
+        handler.is_registered = False
+        self._cancel_timer(handler)
+    def _restore_deferred_timers(self):
+        # Return timers postponed by _check_timers() to the heap
+        heap = self._timer_heap
+        for entry in self._timer_deferred:
+            if entry[2] is None:
+                self._timer_stale -= 1
+                continue
+            heapq.heappush(heap, entry)
+            if entry[0] < self._next_timer:
+                self._next_timer = entry[0]
+        del self._timer_deferred[:]
     def _check_timers(self, eventtime):
         if eventtime < self._next_timer:
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        heap = self._timer_heap
+        deferred = self._timer_deferred
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            if eventtime >= t.waketime:
-                t.waketime = self.NEVER
+        # Timers (re)scheduled while running this pass are not invoked
+        # until the next pass
+        last_seq = self._timer_seq
+        while heap and heap[0][0] <= eventtime:
+            entry = heapq.heappop(heap)
+            t = entry[2]
+            if t is None:
+                self._timer_stale -= 1
+                continue
+            if entry[1] > last_seq:
+                deferred.append(entry)
+                continue
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            if self._profiler is None:
                 t.waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._note_time(t)
+            else:
+                t.waketime = self._profiler.invoke_timer(
+                    t, entry[0], eventtime)
+            if t.is_registered:
+                self._schedule_timer(t)
+            if g_dispatch is not self._g_dispatch:
+                self._restore_deferred_timers()
+                self._end_greenlet(g_dispatch)
+                return 0.
+        self._restore_deferred_timers()
+        # Discard cancelled entries
+        if self._timer_stale > len(heap) // 2 + 64:
+            heap[:] = [entry for entry in heap if entry[2] is not None]
+            heapq.heapify(heap)
+            self._timer_stale = 0
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._timer_stale -= 1
+        if heap:
+            self._next_timer = heap[0][0]
+        else:
+            self._next_timer = self.NEVER
         if eventtime >= self._next_timer:
             return 0.
         return min(1., max(.001, self._next_timer - self.monotonic()))
@@ -91,27 +345,31 @@ class SelectReactor:
     def register_callback(self, callback):
         ReactorCallback(self, callback)
     def register_async_callback(self, callback):
-        self._async_queue.put_nowait(callback)
+        self._async_queue.append(callback)
+        if not self._async_pending:
+            self._async_pending = True
+            self._signal_async()
+    def _signal_async(self):
         try:
             os.write(self._pipe_fds[1], '.')
         except os.error:
             pass
     def _got_pipe_signal(self, eventtime):
+        self._async_pending = False
         try:
             os.read(self._pipe_fds[0], 4096)
         except os.error:
             pass
-        while 1:
-            try:
-                callback = self._async_queue.get_nowait()
-            except Queue.Empty:
-                break
-            ReactorCallback(self, callback)
+        async_queue = self._async_queue
+        while async_queue:
+            ReactorCallback(self, async_queue.popleft())
     def _setup_async_callbacks(self):
         self._pipe_fds = os.pipe()
         util.set_nonblock(self._pipe_fds[0])
         util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        if self._async_pending:
+            self._signal_async()
     def __del__(self):
         if self._pipe_fds is not None:
             os.close(self._pipe_fds[0])
@@ -136,13 +394,24 @@ class SelectReactor:
             g_next = ReactorGreenlet(run=self._dispatch_loop)
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
-        return g_next.switch()
+        self._restore_deferred_timers()
+        profiler = self._profiler
+        if profiler is None:
+            return g_next.switch()
+        profiler.switch_out(g)
+        res = g_next.switch()
+        # Resumed from a timer callback of the current dispatch greenlet
+        profiler.suspend(self._g_dispatch)
+        profiler.resume(g)
+        return res
     def _end_greenlet(self, g_old):
         # Cache this greenlet for later use
         self._greenlets.append(g_old)
         self.unregister_timer(g_old.timer)
         g_old.timer = None
         # Switch to existing dispatch
+        if self._profiler is not None:
+            self._profiler.resume(self._g_dispatch)
         self._g_dispatch.switch(self.NEVER)
         # This greenlet was reactivated - prepare for main processing loop
         self._g_dispatch = g_old
@@ -162,7 +431,10 @@ class SelectReactor:
             res = select.select(self._fds, [], [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
-                fd.callback(eventtime)
+                if self._profiler is None:
+                    fd.callback(eventtime)
+                else:
+                    self._profiler.invoke_fd(fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -176,6 +448,50 @@ class SelectReactor:
         g_next.switch()
     def end(self):
         self._process = False
+    # Greenlet jobs
+    def _run_job(self, job, eventtime):
+        job.start_time = eventtime
+        try:
+            job.result = job.func(*job.args)
+        except:
+            job.exc_info = sys.exc_info()
+        job.end_time = self.monotonic()
+        job.done = True
+        if job.waiting is not None:
+            self.update_timer(job.waiting.timer, self.NOW)
+    def spawn(self, func, *args):
+        # Run func from the reactor so that it may pause independently
+        # of the caller - use wait_jobs() to obtain the result
+        job = ReactorWorkerJob(func, args, self.monotonic())
+        if self._g_dispatch is None:
+            # Reactor not running - run the job directly
+            self._run_job(job, job.submit_time)
+            return job
+        self.register_callback((lambda e: self._run_job(job, e)))
+        return job
+    def wait_jobs(self, jobs):
+        # Pause the calling greenlet until all jobs complete and raise
+        # the error of the first failing job (if any)
+        g = greenlet.getcurrent()
+        for job in jobs:
+            job.waiting = g
+            while not job.done:
+                self.pause(self.NEVER)
+            job.waiting = None
+        for job in jobs:
+            if job.exc_info is not None:
+                exc_info, job.exc_info = job.exc_info, None
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return [job.result for job in jobs]
+    def get_worker_pool(self):
+        if self._worker_pool is None:
+            self._worker_pool = ReactorWorkerPool(self)
+        return self._worker_pool
+    # Profiling
+    def enable_profiler(self, warn_time, logger):
+        if self._profiler is None:
+            self._profiler = ReactorProfiler(self, warn_time, logger)
+        return self._profiler
 
 class PollReactor(SelectReactor):
     def __init__(self):
@@ -204,18 +520,26 @@ class PollReactor(SelectReactor):
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.invoke_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
 
+# Linux reactor using epoll, a timerfd for precise timer wakeups, and
+# an eventfd for async callbacks
 class EPollReactor(SelectReactor):
+    EVENTFD_SIGNAL = struct.pack('=Q', 1)
     def __init__(self):
         SelectReactor.__init__(self)
         self._epoll = select.epoll()
         self._fds = {}
+        self._timerfd = self._timerfd_waketime = None
+        self._timerfd_set_waketime = chelper.get_ffi()[1].timerfd_set_waketime
     # File descriptors
     def register_fd(self, fd, callback):
         handler = ReactorFileHandler(fd, callback)
@@ -229,25 +553,73 @@ class EPollReactor(SelectReactor):
         fds = self._fds.copy()
         del fds[handler.fd]
         self._fds = fds
+    # Callbacks
+    def _signal_async(self):
+        try:
+            os.write(self._pipe_fds[1], self.EVENTFD_SIGNAL)
+        except os.error:
+            pass
+    def _setup_async_callbacks(self):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        efd = ffi_lib.eventfd_alloc()
+        self._pipe_fds = (efd, efd)
+        self.register_fd(efd, self._got_pipe_signal)
+        if self._async_pending:
+            self._signal_async()
+        self._timerfd = ffi_lib.timerfd_alloc()
+        self._timerfd_waketime = self.NEVER
+        self.register_fd(self._timerfd, self._got_timerfd_signal)
+    def __del__(self):
+        if self._pipe_fds is not None:
+            os.close(self._pipe_fds[0])
+            self._pipe_fds = None
+        if self._timerfd is not None:
+            os.close(self._timerfd)
+            self._timerfd = None
+    # Timers
+    def _got_timerfd_signal(self, eventtime):
+        self._timerfd_waketime = self.NEVER
+        try:
+            os.read(self._timerfd, 8)
+        except os.error:
+            pass
+    def _arm_timerfd(self):
+        # Only rearm when the next timer is earlier than the pending
+        # wakeup (an early wakeup just results in another check)
+        waketime = self._next_timer
+        if waketime < self._timerfd_waketime:
+            self._timerfd_waketime = waketime
+            self._timerfd_set_waketime(self._timerfd, waketime)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime)
+            if timeout:
+                # Timer wakeups are signaled by the timerfd
+                self._arm_timerfd()
+                timeout = 1.
             res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.invoke_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
 
-# Use the poll based reactor if it is available
+# Use the epoll based reactor if it is available (or poll otherwise)
 try:
-    select.poll
-    Reactor = PollReactor
+    select.epoll
+    Reactor = EPollReactor
 except:
-    Reactor = SelectReactor
+    try:
+        select.poll
+        Reactor = PollReactor
+    except:
+        Reactor = SelectReactor
@@ -3,7 +3,7 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import os, logging, threading, hashlib
 import serial
 
 import msgproto, chelper, util
@@ -13,7 +13,9 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud, logger=None):
+    PULL_BATCH = 32
+    def __init__(self, reactor, serialport, baud, logger=None,
+                 dictionary_cache=None):
         if logger is not None:
             self.logger = logger
         else:
@@ -21,6 +23,9 @@ class SerialReader:
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.identify_cache = None
+        if dictionary_cache is not None:
+            self.identify_cache = IdentifyCache(dictionary_cache, self.logger)
         # Serial port
         self.ser = None
         self.msgparser = msgproto.MessageParser()
@@ -32,29 +37,37 @@ class SerialReader:
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
-        # Message handlers
+        # Message handlers (the dict is replaced on each update so that
+        # the background thread can read it without taking the lock)
         handlers = {
             '#unknown': self.handle_unknown, '#output': self.handle_output,
             'shutdown': self.handle_output, 'is_shutdown': self.handle_output
         }
         self.handlers = { (k, None): v for k, v in handlers.items() }
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new(
+            'struct pull_queue_message[%d]' % (self.PULL_BATCH,))
+        pull_batch = self.ffi_lib.serialqueue_pull_batch
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = pull_batch(self.serialqueue, responses, self.PULL_BATCH)
             if count <= 0:
                 break
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            with self.lock:
-                hdl = self.handlers.get(hdl, self.handle_default)
-            try:
-                hdl(params)
-            except:
-                self.logger.exception("Exception in serial callback")
+            # Parse the whole batch before dispatching it
+            parse = self.msgparser.parse
+            batch = []
+            for i in range(count):
+                response = responses[i]
+                params = parse(response.msg[0:response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                batch.append(params)
+            for params in batch:
+                hdl = self.handlers.get((params['#name'], params.get('oid')),
+                                        self.handle_default)
+                try:
+                    hdl(params)
+                except:
+                    self.logger.exception("Exception in serial callback")
     def connect(self):
         # Initial connection
         self.logger.info("Connecting to %s @ %s" %
@@ -78,7 +91,8 @@ class SerialReader:
             self.background_thread = threading.Thread(target=self._bg_thread)
             self.background_thread.start()
             # Obtain and load the data dictionary from the firmware
-            sbs = SerialBootStrap(self, self.logger)
+            identify_time = self.reactor.monotonic()
+            sbs = SerialBootStrap(self, self.logger, self.identify_cache)
             identify_data = sbs.get_identify_data(starttime + 5.)
             if identify_data is None:
                 self.logger.warn("Timeout on serial connect [{}]".format(self.serialport,))
@@ -86,7 +100,19 @@ class SerialReader:
                 continue
             break
         msgparser = msgproto.MessageParser()
-        msgparser.process_identify(identify_data)
+        try:
+            msgparser.process_identify(identify_data)
+        except msgproto.error:
+            if sbs.from_cache:
+                self.identify_cache.remove(identify_data)
+            raise
+        if self.identify_cache is not None and not sbs.from_cache:
+            self.identify_cache.store(identify_data)
+        self.logger.info(
+            "Loaded data dictionary (%d bytes, %s) in %.3fs",
+            len(identify_data),
+            "verified cache" if sbs.from_cache else "downloaded",
+            self.reactor.monotonic() - identify_time)
         self.msgparser = msgparser
         self.register_callback(self.handle_unknown, '#unknown')
         # Setup baud adjust
@@ -125,10 +151,14 @@ class SerialReader:
     # Serial response callbacks
     def register_callback(self, callback, name, oid=None):
         with self.lock:
-            self.handlers[name, oid] = callback
+            handlers = dict(self.handlers)
+            handlers[name, oid] = callback
+            self.handlers = handlers
     def unregister_callback(self, name, oid=None):
         with self.lock:
-            del self.handlers[name, oid]
+            handlers = dict(self.handlers)
+            del handlers[name, oid]
+            self.handlers = handlers
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(
@@ -136,6 +166,23 @@ class SerialReader:
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def encode_batch(self, msgs):
+        # Pre-encode a list of commands for later use with send_batch()
+        cmds = [self.msgparser.create_command(msg) for msg in msgs]
+        data = bytearray()
+        for cmd in cmds:
+            data.extend(cmd)
+        return str(data), [len(cmd) for cmd in cmds]
+    def send_batch(self, batch, minclock=0, reqclock=0, cmd_queue=None):
+        # Queue all the commands of an encode_batch() result in one call
+        data, lens = batch
+        if not lens:
+            return
+        if cmd_queue is None:
+            cmd_queue = self.default_cmd_queue
+        self.ffi_lib.serialqueue_send_multi(
+            self.serialqueue, cmd_queue, data, lens, len(lens),
+            minclock, reqclock)
     def lookup_command(self, msgformat, cq=None):
         if cq is None:
             cq = self.default_cmd_queue
@@ -229,10 +276,78 @@ class SerialRetryCommand:
         self.unregister()
         return self.response
 
+# On disk cache of mcu data dictionaries.  Entries are found by the first
+# chunk of the (zlib compressed) dictionary and are only used after the
+# end of the dictionary (which contains the zlib checksum) is verified.
+# Each entry holds the raw dictionary and is named by its sha1 hash.
+class IdentifyCache:
+    CHUNK_SIZE = 40
+    def __init__(self, dirname, logger):
+        self.dirname = os.path.normpath(os.path.expanduser(dirname))
+        self.logger = logger
+    def _prefix(self, first_chunk):
+        return hashlib.sha1(first_chunk).hexdigest()
+    def _get_filename(self, identify_data):
+        return os.path.join(self.dirname, "%s-%s" % (
+            self._prefix(identify_data[:self.CHUNK_SIZE]),
+            hashlib.sha1(identify_data).hexdigest()))
+    def _check_dir(self):
+        # Only use a directory that no other user can write to
+        st = os.stat(self.dirname)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            self.logger.warn("Not using dictionary cache %s (it is writable"
+                             " by other users)", self.dirname)
+            return False
+        return True
+    def lookup(self, first_chunk):
+        # Return a list of cached dictionaries starting with first_chunk
+        prefix = self._prefix(first_chunk) + '-'
+        try:
+            if not self._check_dir():
+                return []
+            filenames = [fname for fname in os.listdir(self.dirname)
+                         if fname.startswith(prefix)]
+        except OSError:
+            return []
+        out = []
+        for fname in filenames:
+            try:
+                f = open(os.path.join(self.dirname, fname), 'rb')
+                data = f.read()
+                f.close()
+            except IOError as e:
+                self.logger.warn("Unable to read dictionary cache %s: %s",
+                                 fname, e)
+                continue
+            if (data[:self.CHUNK_SIZE] == first_chunk
+                and os.path.basename(self._get_filename(data)) == fname):
+                out.append(data)
+        return out
+    def store(self, identify_data):
+        pathname = self._get_filename(identify_data)
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname, 0o700)
+            if not self._check_dir():
+                return
+            tmpname = "%s.tmp%d" % (pathname, os.getpid())
+            f = open(tmpname, 'wb')
+            f.write(identify_data)
+            f.close()
+            os.rename(tmpname, pathname)
+        except (OSError, IOError) as e:
+            self.logger.warn("Unable to write dictionary cache: %s", e)
+    def remove(self, identify_data):
+        try:
+            os.remove(self._get_filename(identify_data))
+        except OSError:
+            pass
+
 # Code to start communication and download message type dictionary
 class SerialBootStrap:
     RETRY_TIME = 0.500
-    def __init__(self, serial, logger=None):
+    CHUNK_SIZE = IdentifyCache.CHUNK_SIZE
+    def __init__(self, serial, logger=None, cache=None):
         if logger is not None:
             self.logger = logger
         else:
@@ -242,6 +357,10 @@ class SerialBootStrap:
         self.identify_cmd = self.serial.lookup_command(
             "identify offset=%u count=%c")
         self.is_done = False
+        # Dictionary cache verification
+        self.cache = cache
+        self.candidates = []
+        self.from_cache = False
         self.serial.register_callback(self.handle_identify, 'identify_response')
         self.serial.register_callback(self.handle_unknown, '#unknown')
         self.send_timer = self.serial.reactor.register_timer(
@@ -255,19 +374,51 @@ class SerialBootStrap:
         if not self.is_done:
             return None
         return self.identify_data
+    def _probe_request(self):
+        # Request the last chunk of the candidate and one more byte -
+        # the response must match the candidate and end with it
+        data = self.candidates[0]
+        count = min(len(data) - 1, self.CHUNK_SIZE)
+        return [len(data) - count, count + 1]
+    def _send_request(self):
+        if self.candidates:
+            self.identify_cmd.send(self._probe_request())
+        else:
+            self.identify_cmd.send([len(self.identify_data), self.CHUNK_SIZE])
+    def _check_candidate(self, offset, msgdata):
+        data = self.candidates[0]
+        if offset != self._probe_request()[0]:
+            return
+        if msgdata == data[offset:]:
+            self.identify_data = data
+            self.from_cache = True
+            self.is_done = True
+            return
+        self.logger.info("Cached data dictionary does not match")
+        del self.candidates[0]
+        self._send_request()
     def handle_identify(self, params):
-        if self.is_done or params['offset'] != len(self.identify_data):
+        if self.is_done:
             return
+        offset = params['offset']
         msgdata = params['data']
+        if self.candidates:
+            self._check_candidate(offset, msgdata)
+            return
+        if offset != len(self.identify_data):
+            return
         if not msgdata:
             self.is_done = True
             return
         self.identify_data += msgdata
-        self.identify_cmd.send([len(self.identify_data), 40])
+        if not offset and self.cache is not None:
+            self.candidates = [c for c in self.cache.lookup(msgdata)
+                               if len(c) > len(msgdata)]
+        self._send_request()
     def send_event(self, eventtime):
         if self.is_done:
             return self.serial.reactor.NEVER
-        self.identify_cmd.send([len(self.identify_data), 40])
+        self._send_request()
         return eventtime + self.RETRY_TIME
     def handle_unknown(self, params):
         self.logger.debug("Unknown message %d (len %d) while identifying",
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math
+import math, sys
 import mcu, homing, cartesian, corexy, delta, extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
@@ -11,7 +11,15 @@ import mcu, homing, cartesian, corexy, delta, extruder
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'is_kinematic_move',
+        'axes_d', 'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2',
+        'delta_v2', 'max_smoothed_v2', 'smooth_delta_v2', 'accel_r',
+        'decel_r', 'cruise_r', 'start_v', 'cruise_v', 'end_v', 'accel_t',
+        'cruise_t', 'decel_t', 'timing_callbacks',
+        # Fields used by the extruder
+        'extrude_r', 'extrude_max_corner_v')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
@@ -33,6 +41,9 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        self.extrude_r = self.extrude_max_corner_v = 0.
+        # Actions to run (with their print_time) once the move is flushed
+        self.timing_callbacks = None
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -94,8 +105,11 @@ class Move:
             self.toolhead.kin.move(next_move_time, self)
         if self.axes_d[3]:
             self.toolhead.extruder.move(next_move_time, self)
-        self.toolhead.update_move_time(
-            self.accel_t + self.cruise_t + self.decel_t)
+        move_t = self.accel_t + self.cruise_t + self.decel_t
+        self.toolhead.update_move_time(move_t)
+        if self.timing_callbacks is not None:
+            for cb in self.timing_callbacks:
+                cb(next_move_time + move_t)
 
 LOOKAHEAD_FLUSH_TIME = 0.250
 
@@ -107,6 +121,8 @@ class MoveQueue:
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        # Instrumentation of the number of moves inspected by flush()
+        self.flush_calls = self.flush_visits = 0
     def reset(self):
         del self.queue[:]
         self.leftover = 0
@@ -115,11 +131,20 @@ class MoveQueue:
         self.junction_flush = flush_time
     def set_extruder(self, extruder):
         self.extruder_lookahead = extruder.lookahead
+    def get_last(self):
+        if self.queue:
+            return self.queue[-1]
+        return None
+    def get_stats(self):
+        return "lookahead_flushes=%d lookahead_visits=%d" % (
+            self.flush_calls, self.flush_visits)
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
+        self.flush_calls += 1
+        self.flush_visits += flush_count - self.leftover
         # Traverse queue from last to first move and determine maximum
         # junction speed assuming the robot comes to a complete stop
         # after the last move.
@@ -182,7 +207,6 @@ class MoveQueue:
             # least one move can be flushed.
             self.flush(lazy=True)
 
-
 STALL_TIME = 0.100
 
 # Main code to track events (and their timing) on the printer toolhead
@@ -334,6 +358,16 @@ class ToolHead:
     def get_last_move_time(self):
         self._flush_lookahead()
         return self.get_next_move_time()
+    def register_lookahead_callback(self, callback):
+        # Run callback(print_time) at the end of the last queued move
+        # once it is flushed, instead of draining the look-ahead queue
+        last_move = self.move_queue.get_last()
+        if last_move is None:
+            callback(self.get_last_move_time())
+            return
+        if last_move.timing_callbacks is None:
+            last_move.timing_callbacks = []
+        last_move.timing_callbacks.append(callback)
     def reset_print_time(self, min_print_time=0.):
         self._flush_lookahead(must_sync=True)
         self.print_time = max(min_print_time, self.mcu.estimated_print_time(
@@ -396,7 +430,7 @@ class ToolHead:
         self._flush_lookahead()
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
-    def move(self, newpos, speed, check=True):
+    def _check_layer_change(self, newpos):
         # Calculate layer time
         commanded_pos = self.commanded_pos
         self.z_hop_detect_cntr += 1
@@ -411,9 +445,10 @@ class ToolHead:
             for cb in self.layer_change_cb:
                 cb(change_time)
             self.z_hop_detect = None
-
+    def move(self, newpos, speed, check=True):
+        self._check_layer_change(newpos)
         speed = min(speed, self.max_velocity)
-        move = Move(self, commanded_pos, newpos, speed)
+        move = Move(self, self.commanded_pos, newpos, speed)
         if not move.move_d:
             return
         if move.is_kinematic_move and check:
@@ -424,6 +459,35 @@ class ToolHead:
         self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
             self._check_stall()
+    def move_batch(self, positions, speeds, check=True):
+        # Queue a series of moves - equivalent to calling move() for
+        # each position, but with the per-move lookups done once for
+        # the whole batch.  Returns the number of positions handled and
+        # the exc_info of the error that stopped the batch (or None).
+        max_velocity = self.max_velocity
+        check_layer_change = self._check_layer_change
+        kin_check_move = self.kin.check_move
+        extruder_check_move = self.extruder.check_move
+        add_move = self.move_queue.add_move
+        commanded_pos = self.commanded_pos
+        i = 0
+        try:
+            for i, (newpos, speed) in enumerate(zip(positions, speeds)):
+                check_layer_change(newpos)
+                move = Move(self, commanded_pos, newpos, min(speed, max_velocity))
+                if not move.move_d:
+                    continue
+                if move.is_kinematic_move and check:
+                    kin_check_move(move)
+                if move.axes_d[3]:
+                    extruder_check_move(move)
+                commanded_pos[:] = newpos
+                add_move(move)
+                if self.print_time > self.need_check_stall:
+                    self._check_stall()
+        except:
+            return i, sys.exc_info()
+        return len(positions), None
     def dwell(self, delay, check_stall=True):
         self.get_last_move_time()
         self.update_move_time(delay)
@@ -466,8 +530,10 @@ class ToolHead:
             m.check_active(self.print_time, eventtime)
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         is_active = buffer_time > -60. or not self.sync_print_time
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        return is_active, (
+            "print_time=%.3f buffer_time=%.3f print_stall=%d %s" % (
+                self.print_time, max(buffer_time, 0.), self.print_stall,
+                self.move_queue.get_stats()))
     def get_status(self, eventtime):
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         if buffer_time > -1. or not self.sync_print_time:
@@ -500,7 +566,10 @@ class ToolHead:
                                   "Args: [VELOCITY=] [ACCEL=] [JUNCTION_DEVIATION=]" \
                                   " [ACCEL_TO_DECEL=] [ACCEL_TO_DECEL_RATIO=]"
     def cmd_SET_VELOCITY_LIMIT(self, params):
-        print_time = self.get_last_move_time()
+        # The limits are captured by each Move when it is queued (and
+        # junction_deviation when it is added to the look-ahead queue),
+        # so new values only apply to subsequent moves and there is no
+        # need to flush the look-ahead queue here.
         gcode = self.printer.lookup_object('gcode')
         max_velocity = gcode.get_float(
             'VELOCITY', params, self.max_velocity,
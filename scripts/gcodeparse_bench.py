@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# Benchmark the g-code line parser on a sliced g-code file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, re, time, optparse, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode
+
+# The parser as implemented before the traditional g-code fast path
+class LegacyParser:
+    args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    def __init__(self, gc):
+        self.gc = gc
+    def parse_line(self, line):
+        line = origline = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        parts = self.args_r.split(line.upper())[1:]
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(0, len(parts), 2) }
+        params['#original'] = origline
+        if parts and parts[0] == 'N':
+            del parts[:2]
+        if not parts:
+            parts = ['', '']
+        params['#command'] = parts[0] + parts[1].strip()
+        # Every handler was wrapped with get_extended_params()
+        return self.gc.get_extended_params(params)
+
+class CurrentParser:
+    def __init__(self, gc):
+        self.gc = gc
+    def parse_line(self, line):
+        gc = self.gc
+        params = gc.parse_line(line)
+        if not gc.is_traditional_gcode(params['#command']):
+            params = gc.get_extended_params(params)
+        return params
+
+# Minimal printer object needed to instantiate the g-code parser
+class DummyPrinter:
+    config_error = Exception
+    logger = logging.getLogger('printer')
+    def get_reactor(self):
+        return None
+    def get_start_args(self):
+        return {}
+
+def run_bench(parser, lines, loops):
+    parse_line = parser.parse_line
+    best = None
+    for i in range(loops):
+        starttime = time.time()
+        for line in lines:
+            parse_line(line)
+        t = time.time() - starttime
+        if best is None or t < best:
+            best = t
+    return len(lines) / best
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--loops", dest="loops", type="int", default=3,
+                    help="number of passes over the file (best is reported)")
+    opts.add_option("-c", "--check", action="store_true", dest="check",
+                    help="verify both parsers produce identical params")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    lines = f.read().split('\n')
+    f.close()
+    gc = gcode.GCodeParser(DummyPrinter(), None)
+    legacy, current = LegacyParser(gc), CurrentParser(gc)
+    if options.check:
+        for line in lines:
+            old, new = legacy.parse_line(line), current.parse_line(line)
+            if old != new:
+                sys.stderr.write("Mismatch on %s: %s vs %s\n" % (
+                    repr(line), old, new))
+                sys.exit(-1)
+    old_rate = run_bench(legacy, lines, options.loops)
+    new_rate = run_bench(current, lines, options.loops)
+    print "%d lines" % (len(lines),)
+    print "before: %.0f lines/s" % (old_rate,)
+    print "after:  %.0f lines/s (%.2fx)" % (new_rate, new_rate / old_rate)
+
+if __name__ == '__main__':
+    main()
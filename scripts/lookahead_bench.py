@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# Benchmark look-ahead flush cost versus window size (with and without
+# pressure advance)
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, time, optparse
+import lookahead_sim
+
+# The pressure advance lookahead as implemented before the single scan
+# per deceleration group
+def legacy_lookahead(self, moves, flush_count, lazy):
+    lookahead_t = self.pressure_advance_lookahead_time
+    if not self.pressure_advance or not lookahead_t:
+        return flush_count
+    for i in range(flush_count):
+        move = moves[i]
+        if not move.decel_t:
+            continue
+        cruise_v = move.cruise_v
+        max_corner_v = 0.
+        sum_t = lookahead_t
+        for j in range(i+1, flush_count):
+            fmove = moves[j]
+            if not fmove.max_start_v2:
+                break
+            if fmove.cruise_v > max_corner_v:
+                if (not max_corner_v
+                    and not fmove.accel_t and not fmove.cruise_t):
+                    continue
+                if sum_t >= fmove.accel_t:
+                    max_corner_v = fmove.cruise_v
+                else:
+                    max_corner_v = max(
+                        max_corner_v, fmove.start_v + fmove.accel * sum_t)
+                if max_corner_v >= cruise_v:
+                    break
+            sum_t -= fmove.accel_t + fmove.cruise_t + fmove.decel_t
+            if sum_t <= 0.:
+                break
+        else:
+            if lazy:
+                return i
+        move.extrude_max_corner_v = max_corner_v
+    return flush_count
+
+class LegacySimToolHead(lookahead_sim.SimToolHead):
+    def __init__(self, options):
+        lookahead_sim.SimToolHead.__init__(self, options)
+        self.extruder.lookahead = legacy_lookahead.__get__(self.extruder)
+        self.move_queue.set_extruder(self.extruder)
+
+NO_FLUSH_TIME = 999999999.
+
+# Queue up 'window' moves at a time and time a full flush of them
+def bench_window(toolhead_class, moves, window, options):
+    th = toolhead_class(options)
+    move_queue = th.move_queue
+    flush_time = count = 0
+    for newpos, speed in moves:
+        move_queue.set_flush_time(NO_FLUSH_TIME)
+        th.move(newpos, speed)
+        if len(move_queue.queue) >= window:
+            starttime = time.time()
+            move_queue.flush()
+            flush_time += time.time() - starttime
+            count += 1
+    if not count:
+        return None, th.log
+    return flush_time / count, th.log
+
+def best_window(toolhead_class, moves, window, options):
+    best = None
+    for i in range(options.loops):
+        flush_time, log = bench_window(toolhead_class, moves, window, options)
+        if best is None or flush_time < best:
+            best = flush_time
+    return best, log
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--max_velocity", type="float", default=300.)
+    opts.add_option("--max_accel", type="float", default=3000.)
+    opts.add_option("--max_accel_to_decel", type="float", default=1500.)
+    opts.add_option("--junction_deviation", type="float", default=0.02)
+    opts.add_option("--buffer_time_high", type="float", default=2.)
+    opts.add_option("--pressure_advance", type="float", default=0.05)
+    opts.add_option("--lookahead_time", type="float", default=0.010)
+    opts.add_option("-n", "--loops", type="int", default=3,
+                    help="number of passes over the file (best is reported)")
+    opts.add_option("-w", "--windows", type="string",
+                    default="50,100,200,400,800,1600",
+                    help="comma separated list of flush window sizes")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    moves = lookahead_sim.read_moves(args[0])
+    pressure_advance = options.pressure_advance
+    # Normal (lazy) planning must match exactly
+    ref_log = lookahead_sim.plan(moves, options)[0]
+    th = LegacySimToolHead(options)
+    for newpos, speed in moves:
+        th.move(newpos, speed)
+    th.flush()
+    if th.log != ref_log:
+        print "FAIL: pressure advance lookahead differs from legacy code"
+        sys.exit(-1)
+    print "%d moves, pressure_advance=%.3f lookahead_time=%.3f" % (
+        len(moves), pressure_advance, options.lookahead_time)
+    print "%8s %12s %12s %12s" % ("window", "pa_off(ms)", "legacy(ms)",
+                                  "pa_on(ms)")
+    for window in [int(w) for w in options.windows.split(',')]:
+        options.pressure_advance = 0.
+        off_time, off_log = best_window(
+            lookahead_sim.SimToolHead, moves, window, options)
+        options.pressure_advance = pressure_advance
+        legacy_time, legacy_log = best_window(
+            LegacySimToolHead, moves, window, options)
+        on_time, on_log = best_window(
+            lookahead_sim.SimToolHead, moves, window, options)
+        if off_time is None:
+            break
+        if on_log != legacy_log:
+            print "FAIL: window %d results differ from legacy code" % (
+                window,)
+            sys.exit(-1)
+        print "%8d %12.3f %12.3f %12.3f" % (
+            window, off_time * 1000., legacy_time * 1000., on_time * 1000.)
+
+if __name__ == '__main__':
+    main()
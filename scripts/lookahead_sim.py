@@ -0,0 +1,141 @@
+#!/usr/bin/env python2
+# Plan a g-code file through the toolhead look-ahead queue
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, time, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead, extruder
+
+# Record the result of Move.set_junction() for every flushed move
+def record_move(log, move):
+    log.append((move.start_pos, move.end_pos, move.accel_r, move.cruise_r,
+                move.decel_r, move.start_v, move.cruise_v, move.end_v,
+                move.accel_t, move.cruise_t, move.decel_t,
+                move.extrude_max_corner_v))
+
+class SimKinematics:
+    def __init__(self, log):
+        self.log = log
+    def move(self, print_time, move):
+        record_move(self.log, move)
+
+# Extruder using the real junction and pressure advance lookahead code
+class SimExtruder:
+    calc_junction = extruder.PrinterExtruder.__dict__['calc_junction']
+    lookahead = extruder.PrinterExtruder.__dict__['lookahead']
+    def __init__(self, log, pressure_advance, lookahead_time):
+        self.log = log
+        self.pressure_advance = pressure_advance
+        self.pressure_advance_lookahead_time = lookahead_time
+    def check_move(self, move):
+        move.extrude_r = move.axes_d[3] / move.move_d
+        move.extrude_max_corner_v = 0.
+    def move(self, print_time, move):
+        if not move.is_kinematic_move:
+            record_move(self.log, move)
+
+class SimToolHead:
+    def __init__(self, options):
+        self.max_velocity = options.max_velocity
+        self.max_accel = options.max_accel
+        self.max_accel_to_decel = options.max_accel_to_decel
+        self.junction_deviation = options.junction_deviation
+        self.print_time = 0.
+        self.log = []
+        self.kin = SimKinematics(self.log)
+        self.extruder = SimExtruder(self.log, options.pressure_advance,
+                                    options.lookahead_time)
+        self.move_queue = toolhead.MoveQueue()
+        self.move_queue.set_extruder(self.extruder)
+        self.move_queue.set_flush_time(options.buffer_time_high)
+        self.commanded_pos = [0., 0., 0., 0.]
+    def get_next_move_time(self):
+        return self.print_time
+    def update_move_time(self, movetime):
+        self.print_time += movetime
+    def move(self, newpos, speed):
+        move = toolhead.Move(self, self.commanded_pos, newpos,
+                             min(speed, self.max_velocity))
+        if not move.move_d:
+            return
+        if move.axes_d[3]:
+            self.extruder.check_move(move)
+        self.commanded_pos[:] = newpos
+        self.move_queue.add_move(move)
+    def flush(self):
+        self.move_queue.flush()
+
+# Convert g-code lines to absolute (position, speed) move requests
+def read_moves(filename):
+    moves = []
+    absolutecoord = absoluteextrude = True
+    base_pos = [0., 0., 0., 0.]
+    last_pos = [0., 0., 0., 0.]
+    speed = 25.
+    for line in open(filename, 'rb'):
+        words = line.split(';', 1)[0].upper().split()
+        if not words:
+            continue
+        cmd = words[0]
+        params = {}
+        for w in words[1:]:
+            try:
+                params[w[0]] = float(w[1:])
+            except ValueError:
+                pass
+        if cmd in ('G0', 'G1'):
+            for i, axis in enumerate('XYZE'):
+                if axis not in params:
+                    continue
+                if not absolutecoord or (i == 3 and not absoluteextrude):
+                    last_pos[i] += params[axis]
+                else:
+                    last_pos[i] = params[axis] + base_pos[i]
+            if params.get('F', 0.) > 0.:
+                speed = params['F'] / 60.
+            moves.append((list(last_pos), speed))
+        elif cmd == 'G90':
+            absolutecoord = True
+        elif cmd == 'G91':
+            absolutecoord = False
+        elif cmd == 'M82':
+            absoluteextrude = True
+        elif cmd == 'M83':
+            absoluteextrude = False
+        elif cmd == 'G92':
+            for i, axis in enumerate('XYZE'):
+                if axis in params:
+                    base_pos[i] = last_pos[i] - params[axis]
+            if not params:
+                base_pos = list(last_pos)
+    return moves
+
+def plan(moves, options):
+    th = SimToolHead(options)
+    starttime = time.time()
+    for newpos, speed in moves:
+        th.move(newpos, speed)
+    th.flush()
+    return th.log, time.time() - starttime, th.move_queue.get_stats()
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--max_velocity", type="float", default=300.)
+    opts.add_option("--max_accel", type="float", default=3000.)
+    opts.add_option("--max_accel_to_decel", type="float", default=1500.)
+    opts.add_option("--junction_deviation", type="float", default=0.02)
+    opts.add_option("--buffer_time_high", type="float", default=2.)
+    opts.add_option("--pressure_advance", type="float", default=0.)
+    opts.add_option("--lookahead_time", type="float", default=0.010)
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    moves = read_moves(args[0])
+    log, plan_time, stats = plan(moves, options)
+    print "%d requested moves, %d planned in %.3fs" % (
+        len(moves), len(log), plan_time)
+    print stats
+
+if __name__ == '__main__':
+    main()
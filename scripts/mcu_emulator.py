@@ -0,0 +1,584 @@
+#!/usr/bin/env python2
+# Emulate a micro-controller on a pseudo-tty for host benchmarking
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, re, json, zlib, heapq, select, tty, collections, optparse
+import logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import util, msgproto, chelper
+
+SRCDIR = os.path.join(os.path.dirname(__file__), '../src')
+EMULATOR_SHUTDOWNS = [
+    "Command request", "Move queue empty", "Invalid count parameter",
+    "Timer too close", "Stepper too far in past", "Invalid oid type",
+    "Can't reset time when stepper active", "Already finalized",
+    "Shutdown cleared when not shutdown",
+    "config_reset only available when shutdown"]
+
+
+######################################################################
+# Data dictionary
+######################################################################
+
+# Extract the message formats and flags declared in the firmware source
+def scan_source(srcdir, filenames):
+    re_string = r'((?:"[^"]*"\s*)+)'
+    re_command = re.compile(r'DECL_COMMAND(?:_FLAGS)?\(\s*\w+\s*,'
+                            r'(?:\s*(\w+)\s*,)?\s*' + re_string + r'\)')
+    re_sendf = re.compile(r'sendf\(\s*' + re_string)
+    re_shutdown = re.compile(r'shutdown\(\s*' + re_string + r'\)')
+    re_constant = re.compile(r'DECL_CONSTANT\(\s*(\w+)\s*,\s*(\w+)\s*\)')
+    re_define = re.compile(r'^(?:#define\s+|\s+)(\w+)(?:\s+|\s*=\s*)'
+                           r'([0-9a-fA-FxX<>| ()]+?),?\s*$', re.M)
+    def join_strings(s):
+        return ''.join(re.findall(r'"([^"]*)"', s))
+    commands = {}
+    responses = set()
+    shutdowns = set()
+    constants = {}
+    for fname in filenames:
+        f = open(os.path.join(srcdir, fname), 'rb')
+        data = f.read()
+        f.close()
+        for flags, fmt in re_command.findall(data):
+            fmt = join_strings(fmt)
+            commands[fmt] = 'HF_IN_SHUTDOWN' in flags
+        for fmt in re_sendf.findall(data):
+            responses.add(join_strings(fmt))
+        for msg in re_shutdown.findall(data):
+            shutdowns.add(join_strings(msg))
+        # Constants defined by a numeric #define or enum in the same file
+        defines = dict(re_define.findall(data))
+        for name, value in re_constant.findall(data):
+            value = defines.get(value, value)
+            try:
+                constants[name] = int(eval(value, {}))
+            except Exception:
+                pass
+    return commands, responses, shutdowns, constants
+
+# Return the names of the commands the firmware runs while shutdown
+def find_shutdown_commands(srcdir):
+    filenames = []
+    for root, dirs, files in os.walk(srcdir):
+        filenames.extend([os.path.relpath(os.path.join(root, fname), srcdir)
+                          for fname in files if fname.endswith('.c')])
+    commands, responses, shutdowns, constants = scan_source(
+        srcdir, filenames)
+    return set([fmt.split()[0] for fmt, in_shutdown in commands.items()
+                if in_shutdown])
+
+# Build a data dictionary from the generic (board independent) code
+def build_dictionary(srcdir, mcu_type, clock_freq, baud):
+    filenames = [fname for fname in os.listdir(srcdir)
+                 if fname.endswith('.c')]
+    commands, responses, shutdowns, constants = scan_source(
+        srcdir, filenames)
+    # Support restart_method "command" (as done by the linux mcu)
+    commands["config_reset"] = True
+    messages = dict(msgproto.DefaultMessages)
+    fixed = set(messages.values())
+    for fmt in sorted(commands.keys()) + sorted(responses):
+        if fmt not in fixed:
+            fixed.add(fmt)
+            messages[len(messages)] = fmt
+    command_ids = [msgid for msgid, fmt in messages.items()
+                   if fmt in commands]
+    static_strings = sorted(shutdowns | set(EMULATOR_SHUTDOWNS))
+    config = dict(constants)
+    config.update({'MCU': mcu_type, 'CLOCK_FREQ': clock_freq,
+                   'ADC_MAX': 1023, 'PWM_MAX': 255})
+    if baud:
+        config['SERIAL_BAUD'] = baud
+    return {
+        'messages': messages,
+        'commands': sorted(command_ids),
+        'responses': sorted([msgid for msgid in messages
+                             if msgid not in command_ids]),
+        'static_strings': dict((i + 1, s)
+                               for i, s in enumerate(static_strings)),
+        'config': config,
+        'version': 'emulator',
+        'build_versions': 'mcu_emulator.py',
+    }
+
+
+######################################################################
+# Emulated firmware objects
+######################################################################
+
+# A stepper with a queue of moves.  Steps are not generated - instead
+# the time of the last step of each move is calculated and the next
+# move is loaded at that time (which is when the firmware frees the
+# move queue slot).
+class EmuStepper:
+    def __init__(self, emu, oid):
+        self.emu = emu
+        self.oid = oid
+        self.moves = collections.deque()
+        self.next_step_time = 0
+        self.active_end = None
+        self.next_dir = 0
+        self.position = 0
+    def _load(self, move, load_clock):
+        interval, count, add, mdir = move
+        self.emu.moves_free += 1
+        first_step = self.next_step_time + interval
+        if first_step < load_clock - self.emu.late_ticks:
+            self.emu.shutdown("Stepper too far in past")
+            return
+        self.next_step_time += count * interval + add * count * (count-1) // 2
+        self.active_end = self.next_step_time
+        if mdir:
+            self.position -= count
+        else:
+            self.position += count
+    def queue_step(self, interval, count, add, now):
+        move = (interval, count, add, self.next_dir)
+        if self.active_end is not None:
+            self.moves.append(move)
+            return
+        if self.next_step_time + interval < now:
+            self.emu.shutdown("Timer too close")
+            return
+        self._load(move, now)
+    def advance(self, now):
+        while self.active_end is not None and self.active_end <= now:
+            if not self.moves:
+                self.active_end = None
+                break
+            self._load(self.moves.popleft(), self.active_end)
+    def stop(self):
+        self.emu.moves_free += len(self.moves)
+        self.moves.clear()
+        if self.active_end is not None:
+            self.next_step_time = self.emu.get_clock()
+            self.active_end = None
+    def is_active(self):
+        return self.active_end is not None
+
+class EmuEndstop:
+    def __init__(self, emu, oid):
+        self.emu = emu
+        self.oid = oid
+        self.steppers = {}
+        self.homing = 0
+        self.pin_value = 0
+        self.home_start = 0
+        self.check_ticks = 0
+        self.was_active = False
+    def home(self, clock, rest_ticks, pin_value):
+        self.homing = int(rest_ticks != 0)
+        self.pin_value = pin_value
+        self.was_active = False
+        if not self.homing:
+            return
+        self.home_start = self.emu.clock32_to_64(clock)
+        self.check_ticks = max(rest_ticks, self.emu.freq // 1000)
+        self.emu.add_timer(self.home_start, self.check)
+    def check(self, now):
+        # Trigger after the home time or when all steppers stop moving
+        if not self.homing:
+            return None
+        self.emu.advance_steppers(now)
+        active = [s for s in self.steppers.values() if s.is_active()]
+        self.was_active |= bool(active)
+        if (now < self.home_start + self.emu.home_ticks
+            and (active or not self.was_active)):
+            return now + self.check_ticks
+        for s in self.steppers.values():
+            s.stop()
+        self.homing = 0
+        self.report()
+        return None
+    def report(self):
+        pin = self.pin_value if not self.homing else self.pin_value ^ 1
+        self.emu.send("end_stop_state", oid=self.oid, homing=self.homing,
+                      pin=pin)
+
+# A periodically reported sensor (analog_in or thermocouple).  The
+# reported value is always the middle of the allowed range.
+class EmuSensor:
+    def __init__(self, emu, oid, response, **extra):
+        self.emu = emu
+        self.oid = oid
+        self.response = response
+        self.extra = extra
+        self.rest_ticks = self.value = 0
+        self.next_clock = 0
+        self.query_id = 0
+    def query(self, clock, rest_ticks, min_value, max_value):
+        self.query_id += 1
+        if not clock:
+            return
+        self.rest_ticks = rest_ticks
+        self.value = (min_value + max_value) // 2
+        self.next_clock = self.emu.clock32_to_64(clock)
+        query_id = self.query_id
+        self.emu.add_timer(self.next_clock,
+                           (lambda now: self.report(now, query_id)))
+    def report(self, now, query_id):
+        if query_id != self.query_id:
+            return None
+        self.next_clock += self.rest_ticks
+        self.emu.send(self.response, oid=self.oid,
+                      next_clock=self.next_clock & 0xffffffff,
+                      value=self.value, **self.extra)
+        return self.next_clock
+
+
+######################################################################
+# Micro-controller emulation
+######################################################################
+
+class MCUEmulator:
+    def __init__(self, fd, dictionary, shutdown_commands, options):
+        self.fd = fd
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.process_identify(json.dumps(dictionary),
+                                        decompress=False)
+        self.identify_data = zlib.compress(json.dumps(dictionary), 9)
+        self.shutdown_commands = shutdown_commands
+        self.static_string_ids = dict(
+            (s, int(i)) for i, s in dictionary['static_strings'].items())
+        self.freq = int(self.msgparser.get_constant_float('CLOCK_FREQ'))
+        self.late_ticks = self.freq // 1000
+        self.home_ticks = int(options.home_time * self.freq)
+        self.move_count = options.move_count
+        self.start_time = self.ffi_lib.get_monotonic()
+        # Serial bandwidth limit
+        baud = options.baud
+        if baud is None:
+            baud = self.msgparser.get_constant_float('SERIAL_BAUD', 0.)
+        self.byte_rate = baud / 10.
+        self.input_tokens = self.output_tokens = 0.
+        self.last_token_time = self.start_time
+        self.input_buf = bytearray()
+        self.output_buf = bytearray()
+        # Protocol state
+        self.next_sequence = msgproto.MESSAGE_DEST
+        self.need_sync = self.need_valid = False
+        self.is_shutdown = False
+        self.shutdown_reason = 0
+        self.timers = []
+        self.timer_seq = 0
+        self.stats_count = self.stats_sum = self.stats_sumsq = 0
+        self.stats_send_time = 0
+        self._config_reset()
+        self.handlers = {
+            'identify': self.cmd_identify, 'get_uptime': self.cmd_get_uptime,
+            'get_clock': self.cmd_get_clock, 'get_config': self.cmd_get_config,
+            'allocate_oids': self.cmd_allocate_oids,
+            'finalize_config': self.cmd_finalize_config,
+            'config_reset': self.cmd_config_reset,
+            'emergency_stop': self.cmd_emergency_stop,
+            'clear_shutdown': self.cmd_clear_shutdown,
+            'config_stepper': self.cmd_config_stepper,
+            'queue_step': self.cmd_queue_step,
+            'set_next_step_dir': self.cmd_set_next_step_dir,
+            'reset_step_clock': self.cmd_reset_step_clock,
+            'stepper_get_position': self.cmd_stepper_get_position,
+            'config_end_stop': self.cmd_config_end_stop,
+            'end_stop_set_stepper': self.cmd_end_stop_set_stepper,
+            'end_stop_home': self.cmd_end_stop_home,
+            'end_stop_query': self.cmd_end_stop_query,
+            'config_analog_in': self.cmd_config_analog_in,
+            'query_analog_in': self.cmd_query_sensor,
+            'config_thermocouple': self.cmd_config_thermocouple,
+            'query_thermocouple': self.cmd_query_sensor,
+            'spi_transfer': self.cmd_spi_transfer,
+            'debug_ping': self.cmd_debug_ping,
+        }
+    def _config_reset(self):
+        self.is_config = 0
+        self.config_crc = 0
+        self.moves_free = 0
+        self.steppers = {}
+        self.endstops = {}
+        self.sensors = {}
+        del self.timers[:]
+    # Clock
+    def get_clock(self):
+        return int((self.ffi_lib.get_monotonic() - self.start_time)
+                   * self.freq)
+    def clock32_to_64(self, clock32):
+        now = self.get_clock()
+        clock = (now & ~0xffffffff) | clock32
+        if clock > now + 0x80000000:
+            clock -= 0x100000000
+        elif clock < now - 0x80000000:
+            clock += 0x100000000
+        return clock
+    def add_timer(self, waketime, callback):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (waketime, self.timer_seq, callback))
+    def _run_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            waketime, seq, callback = heapq.heappop(self.timers)
+            nexttime = callback(now)
+            if nexttime is not None:
+                self.add_timer(nexttime, callback)
+        if now >= self.stats_send_time + 5 * self.freq:
+            self.send("stats", count=self.stats_count,
+                      sum=self.stats_sum & 0xffffffff,
+                      sumsq=min(self.stats_sumsq, 0xffffffff))
+            self.stats_send_time = now
+            self.stats_count = self.stats_sum = self.stats_sumsq = 0
+    def advance_steppers(self, now):
+        for s in self.steppers.values():
+            s.advance(now)
+    # Message transmission
+    def send(self, name, **params):
+        mp = self.msgparser
+        cmd = mp.messages_by_name[name].encode_by_name(**params)
+        self.output_buf.extend(mp.encode(self.next_sequence, cmd))
+    def _send_ack(self):
+        self.output_buf.extend(self.msgparser.encode(self.next_sequence, []))
+    def shutdown(self, reason):
+        if self.is_shutdown:
+            return
+        logging.info("Shutdown: %s", reason)
+        self.is_shutdown = True
+        self.shutdown_reason = self.static_string_ids.get(reason, 0)
+        for s in self.steppers.values():
+            s.stop()
+        del self.timers[:]
+        self.send("shutdown", clock=self.get_clock() & 0xffffffff,
+                  static_string_id=self.shutdown_reason)
+    # Message block processing (see command_find_block() in the firmware)
+    def _process_input(self):
+        buf = self.input_buf
+        pos = 0
+        while pos < len(buf):
+            if self.need_sync:
+                sync = buf.find(chr(msgproto.MESSAGE_SYNC_BYTE), pos)
+                if sync < 0:
+                    pos = len(buf)
+                    break
+                pos = sync + 1
+                self.need_sync = False
+                continue
+            msglen = msgproto.check_frame(buf, pos)
+            if not msglen:
+                break
+            if msglen < 0:
+                if buf[pos] == msgproto.MESSAGE_SYNC_BYTE:
+                    pos += 1
+                    continue
+                self.need_sync = True
+                if not self.need_valid:
+                    self.need_valid = True
+                    self._send_ack()
+                continue
+            self.need_valid = False
+            block = buf[pos:pos+msglen]
+            pos += msglen
+            if block[msgproto.MESSAGE_POS_SEQ] != self.next_sequence:
+                # Lost message - wait for retransmit
+                self._send_ack()
+                continue
+            self.next_sequence = (
+                (self.next_sequence + 1) & msgproto.MESSAGE_SEQ_MASK
+                | msgproto.MESSAGE_DEST)
+            if msglen > msgproto.MESSAGE_MIN:
+                self._dispatch(block)
+            self._send_ack()
+        del buf[:pos]
+    def _dispatch(self, block):
+        now = self.get_clock()
+        self.advance_steppers(now)
+        for mid, params, length in self.msgparser.iter_commands(block):
+            name = mid.name
+            if self.is_shutdown and name not in self.shutdown_commands:
+                self.send("is_shutdown",
+                          static_string_id=self.shutdown_reason)
+                continue
+            handler = self.handlers.get(name)
+            if handler is not None:
+                handler(params, now)
+    # Serial port emulation
+    def _update_tokens(self, eventtime):
+        if not self.byte_rate:
+            self.input_tokens = self.output_tokens = float(1<<20)
+            return
+        tokens = (eventtime - self.last_token_time) * self.byte_rate
+        self.last_token_time = eventtime
+        burst = max(msgproto.MESSAGE_MAX, self.byte_rate * .002)
+        self.input_tokens = min(self.input_tokens + tokens, burst)
+        self.output_tokens = min(self.output_tokens + tokens, burst)
+    def run(self):
+        fd = self.fd
+        while 1:
+            eventtime = self.ffi_lib.get_monotonic()
+            now = int((eventtime - self.start_time) * self.freq)
+            self._run_timers(now)
+            self._update_tokens(eventtime)
+            # Transmit
+            if self.output_buf and self.output_tokens >= 1.:
+                count = min(len(self.output_buf), int(self.output_tokens))
+                try:
+                    count = os.write(fd, str(self.output_buf[:count]))
+                except OSError:
+                    count = 0
+                del self.output_buf[:count]
+                self.output_tokens -= count
+            # Wait for input (or the next timer / bandwidth slot)
+            timeout = 0.100
+            if self.timers:
+                timeout = min(timeout, max(
+                    0., float(self.timers[0][0] - now) / self.freq))
+            if self.byte_rate and (self.input_tokens < 1.
+                                   or self.output_buf):
+                timeout = min(timeout, 1. / self.byte_rate)
+            rfds = [fd] if self.input_tokens >= 1. else []
+            wfds = [fd] if self.output_buf and self.output_tokens >= 1. else []
+            rfds, wfds, xfds = select.select(rfds, wfds, [], timeout)
+            if not rfds:
+                continue
+            start_clock = self.get_clock()
+            try:
+                data = os.read(fd, min(4096, int(self.input_tokens)))
+            except OSError:
+                continue
+            self.input_tokens -= len(data)
+            self.input_buf.extend(data)
+            self._process_input()
+            # Task statistics (processing time in clock ticks)
+            diff = self.get_clock() - start_clock
+            self.stats_count += 1
+            self.stats_sum += diff
+            self.stats_sumsq += (diff * diff + 255) // 256
+    # Command handlers
+    def cmd_identify(self, params, now):
+        offset = params['offset']
+        data = self.identify_data[offset:offset + params['count']]
+        self.send("identify_response", offset=offset, data=data)
+    def cmd_get_uptime(self, params, now):
+        self.send("uptime", high=now >> 32, clock=now & 0xffffffff)
+    def cmd_get_clock(self, params, now):
+        self.send("clock", clock=now & 0xffffffff)
+    def cmd_get_config(self, params, now):
+        self.send("config", is_config=self.is_config, crc=self.config_crc,
+                  move_count=self.move_count if self.is_config else 0,
+                  is_shutdown=int(self.is_shutdown))
+    def cmd_allocate_oids(self, params, now):
+        pass
+    def cmd_finalize_config(self, params, now):
+        if self.is_config:
+            self.shutdown("Already finalized")
+            return
+        self.is_config = 1
+        self.config_crc = params['crc']
+        self.moves_free = self.move_count
+        self.cmd_get_config(params, now)
+    def cmd_config_reset(self, params, now):
+        if not self.is_shutdown:
+            self.shutdown("config_reset only available when shutdown")
+            return
+        self._config_reset()
+        self.is_shutdown = False
+    def cmd_emergency_stop(self, params, now):
+        self.shutdown("Command request")
+    def cmd_clear_shutdown(self, params, now):
+        if not self.is_shutdown:
+            self.shutdown("Shutdown cleared when not shutdown")
+            return
+        self.is_shutdown = False
+    def cmd_config_stepper(self, params, now):
+        self.steppers[params['oid']] = EmuStepper(self, params['oid'])
+    def cmd_queue_step(self, params, now):
+        s = self.steppers[params['oid']]
+        if not params['count']:
+            self.shutdown("Invalid count parameter")
+            return
+        if not self.moves_free:
+            self.shutdown("Move queue empty")
+            return
+        self.moves_free -= 1
+        s.queue_step(params['interval'], params['count'], params['add'], now)
+    def cmd_set_next_step_dir(self, params, now):
+        self.steppers[params['oid']].next_dir = params['dir']
+    def cmd_reset_step_clock(self, params, now):
+        s = self.steppers[params['oid']]
+        if s.is_active():
+            self.shutdown("Can't reset time when stepper active")
+            return
+        s.next_step_time = self.clock32_to_64(params['clock'])
+    def cmd_stepper_get_position(self, params, now):
+        s = self.steppers[params['oid']]
+        self.send("stepper_position", oid=s.oid, pos=s.position)
+    def cmd_config_end_stop(self, params, now):
+        self.endstops[params['oid']] = EmuEndstop(self, params['oid'])
+    def cmd_end_stop_set_stepper(self, params, now):
+        e = self.endstops[params['oid']]
+        e.steppers[params['pos']] = self.steppers[params['stepper_oid']]
+    def cmd_end_stop_home(self, params, now):
+        e = self.endstops[params['oid']]
+        e.home(params['clock'], params['rest_ticks'], params['pin_value'])
+    def cmd_end_stop_query(self, params, now):
+        self.endstops[params['oid']].report()
+    def cmd_config_analog_in(self, params, now):
+        self.sensors[params['oid']] = EmuSensor(
+            self, params['oid'], "analog_in_state")
+    def cmd_config_thermocouple(self, params, now):
+        self.sensors[params['oid']] = EmuSensor(
+            self, params['oid'], "thermocouple_result", fault=0)
+    def cmd_query_sensor(self, params, now):
+        self.sensors[params['oid']].query(
+            params['clock'], params['rest_ticks'], params['min_value'],
+            params['max_value'])
+    def cmd_spi_transfer(self, params, now):
+        self.send("spi_transfer_response", oid=params['oid'],
+                  response='\x00' * len(params['data']))
+    def cmd_debug_ping(self, params, now):
+        self.send("pong", data=params['data'])
+
+def main():
+    usage = "%prog [options] <pty name>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", type="string", dest="dictionary",
+                    help="data dictionary from a build (out/klipper.dict)")
+    opts.add_option("-m", "--mcu", type="string", dest="mcu",
+                    default="atmega2560", help="mcu type (without -d)")
+    opts.add_option("-f", "--freq", type="int", dest="freq",
+                    default=16000000, help="clock frequency (without -d)")
+    opts.add_option("-b", "--baud", type="int", dest="baud",
+                    help="serial bandwidth limit (0 to disable)")
+    opts.add_option("-q", "--move-count", type="int", dest="move_count",
+                    default=500, help="size of the move queue")
+    opts.add_option("--home-time", type="float", dest="home_time",
+                    default=0.500, help="time until an endstop triggers")
+    opts.add_option("-v", action="store_true", dest="verbose",
+                    help="enable debug messages")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=(logging.DEBUG if options.verbose
+                               else logging.INFO))
+    if options.dictionary is not None:
+        f = open(options.dictionary, 'rb')
+        dictionary = json.load(f)
+        f.close()
+    else:
+        baud = options.baud
+        if baud is None:
+            baud = 250000
+        dictionary = build_dictionary(SRCDIR, options.mcu, options.freq, baud)
+    shutdown_commands = find_shutdown_commands(SRCDIR)
+    # Create the pseudo-tty (the slave side is kept open so that the
+    # emulator survives host disconnects)
+    fd = util.create_pty(args[0])
+    slave_fd = os.open(os.readlink(args[0]), os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(slave_fd)
+    emu = MCUEmulator(fd, dictionary, shutdown_commands, options)
+    logging.info("Emulating mcu '%s' on %s",
+                 emu.msgparser.get_constant('MCU'), args[0])
+    try:
+        emu.run()
+    except KeyboardInterrupt:
+        pass
+    os.close(slave_fd)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+# Report the Move object size, garbage collections, and peak memory use
+# while planning a g-code file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, gc, time, resource, optparse
+import lookahead_sim
+
+# Discard the planned moves (only the allocation behaviour is of interest)
+class NullLog:
+    def append(self, item):
+        pass
+
+# Count garbage collector runs from gc.get_count() deltas.  A collection
+# of a generation resets its count and increments the count of the next
+# generation, so every run changes the count of generation 1 or 2.
+class GCCounter:
+    def __init__(self):
+        self.collections = 0
+        self.last_count = gc.get_count()
+    def check(self):
+        count = gc.get_count()
+        last_count = self.last_count
+        if count[1] != last_count[1] or count[2] != last_count[2]:
+            self.collections += 1
+        self.last_count = count
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--max_velocity", type="float", default=300.)
+    opts.add_option("--max_accel", type="float", default=3000.)
+    opts.add_option("--max_accel_to_decel", type="float", default=1500.)
+    opts.add_option("--junction_deviation", type="float", default=0.02)
+    opts.add_option("--buffer_time_high", type="float", default=2.)
+    opts.add_option("--pressure_advance", type="float", default=0.)
+    opts.add_option("--lookahead_time", type="float", default=0.010)
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    moves = lookahead_sim.read_moves(args[0])
+    th = lookahead_sim.SimToolHead(options)
+    th.log = th.kin.log = th.extruder.log = NullLog()
+    move_size = sys.getsizeof(lookahead_sim.toolhead.Move(
+        th, [0., 0., 0., 0.], [1., 0., 0., 0.], 1.))
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gc.collect()
+    gc_counter = GCCounter()
+    starttime = time.time()
+    for newpos, speed in moves:
+        th.move(newpos, speed)
+        gc_counter.check()
+    th.flush()
+    gc_counter.check()
+    plan_time = time.time() - starttime
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%d moves planned in %.3fs (%d bytes per Move)" % (
+        len(moves), plan_time, move_size)
+    print "gc_collections=%d peak_rss=%dKiB (%dKiB before planning)" % (
+        gc_counter.collections, peak_rss, start_rss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+# Benchmark the generic and compiled msgproto encoders and parsers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, timeit, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Message formats on the hot paths (with typical parameters)
+FORMATS = [
+    ("queue_step oid=%c interval=%u count=%hu add=%hi", [3, 25000, 120, -7]),
+    ("set_next_step_dir oid=%c dir=%c", [3, 1]),
+    ("analog_in_state oid=%c next_clock=%u value=%hu",
+     [5, 3000000000, 28000]),
+    ("clock clock=%u", [4000000000]),
+    ("schedule_digital_out oid=%c clock=%u value=%c", [7, 123456789, 1]),
+    ("spi_transfer oid=%c data=%*s", [2, "\x6f\x00\x00\x00\x00"]),
+]
+
+def bench(func, count):
+    return min(timeit.repeat(func, repeat=3, number=count)) * 1000000. / count
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", default=100000,
+                    help="number of calls per measurement")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    count = options.count
+    print "%-22s %-17s %-17s %-17s" % (
+        "(us/call)", "encode", "encode_by_name", "parse")
+    print "%-22s %8s %8s %8s %8s %8s %8s" % (
+        "", "generic", "compiled", "generic", "compiled", "generic",
+        "compiled")
+    for msgid, (msgformat, params) in enumerate(FORMATS):
+        mf = msgproto.MessageFormat(msgid + 10, msgformat)
+        named = dict((name, v) for (name, t), v in zip(mf.param_names,
+                                                       params))
+        data = mf.encode(params)
+        if (mf.parse_ref(data, 0) != mf.parse(data, 0)
+            or mf.encode_ref(params) != data):
+            print "FAIL: %s results differ" % (mf.name,)
+            sys.exit(-1)
+        times = [
+            bench(lambda: mf.encode_ref(params), count),
+            bench(lambda: mf.encode(params), count),
+            bench(lambda: mf.encode_by_name_ref(**named), count),
+            bench(lambda: mf.encode_by_name(**named), count),
+            bench(lambda: mf.parse_ref(data, 0), count),
+            bench(lambda: mf.parse(data, 0), count)]
+        print "%-22s %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f" % (
+            tuple([mf.name]) + tuple(times))
+
+if __name__ == '__main__':
+    main()
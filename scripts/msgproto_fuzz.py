@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+# Check the compiled msgproto encoders/parsers against the generic code
+# with random message formats and parameters
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, random, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Parameter types and the range of values to test for each
+INT_RANGES = {
+    '%u': (-(1<<31), (1<<32) - 1), '%i': (-(1<<31), (1<<31) - 1),
+    '%hu': (0, (1<<16) - 1), '%hi': (-(1<<15), (1<<15) - 1),
+    '%c': (0, (1<<8) - 1),
+}
+STRING_TYPES = ['%s', '%.*s', '%*s']
+
+def random_int(rnd, fmt):
+    minval, maxval = INT_RANGES[fmt]
+    choice = rnd.random()
+    if choice < .3:
+        # Values around the encoding length boundaries
+        edge = rnd.choice([0x20, 0x60, 0x1000, 0x3000, 0x80000, 0x180000,
+                           0x4000000, 0xc000000])
+        v = rnd.choice([edge, -edge]) + rnd.randint(-2, 1)
+    elif choice < .5:
+        v = rnd.randint(-0x40, 0x80)
+    else:
+        v = rnd.randint(minval, maxval)
+    return max(minval, min(maxval, v))
+
+def random_format(rnd):
+    params = []
+    for i in range(rnd.randint(0, 6)):
+        fmt = rnd.choice(INT_RANGES.keys() + STRING_TYPES)
+        params.append(("param%d" % (i,), fmt))
+    if rnd.random() < .3:
+        params.append(("oid", "%c"))
+    rnd.shuffle(params)
+    return "fuzz_msg " + " ".join(["%s=%s" % p for p in params])
+
+def expected_value(t, v):
+    if t.is_int and not t.signed:
+        return v & 0xffffffff
+    return v
+
+def check(msgid, msgformat, values):
+    mf = msgproto.MessageFormat(msgid, msgformat)
+    named = dict((name, v) for (name, t), v in zip(mf.param_names, values))
+    data = mf.encode_ref(values)
+    if mf.encode(values) != data:
+        return "encode differs"
+    if (mf.encode_by_name(**named) != data
+        or mf.encode_by_name_ref(**named) != data):
+        return "encode_by_name differs"
+    # Parse with trailing data to check the returned position
+    stream = data + [0x7e] * 3
+    params, pos = mf.parse(stream, 0)
+    if (params, pos) != mf.parse_ref(stream, 0):
+        return "parse differs"
+    if pos != len(data):
+        return "parse position %d (expected %d)" % (pos, len(data))
+    for (name, t), v in zip(mf.param_names, values):
+        if params[name] != expected_value(t, v):
+            return "round trip of %s: %r vs %r" % (name, params[name], v)
+    return None
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", default=20000,
+                    help="number of random messages to check")
+    opts.add_option("-s", "--seed", type="int", default=None,
+                    help="random seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    seed = options.seed
+    if seed is None:
+        seed = random.randrange(1<<30)
+    rnd = random.Random(seed)
+    print "Checking %d messages (seed %d)" % (options.count, seed)
+    for i in range(options.count):
+        msgid = rnd.randint(0, 127)
+        msgformat = random_format(rnd)
+        values = []
+        for part in msgformat.split()[1:]:
+            fmt = part.split('=')[1]
+            if fmt in INT_RANGES:
+                values.append(random_int(rnd, fmt))
+            else:
+                length = rnd.randint(0, msgproto.MESSAGE_PAYLOAD_MAX // 2)
+                values.append(''.join([chr(rnd.randint(0, 255))
+                                       for j in range(length)]))
+        err = check(msgid, msgformat, values)
+        if err is not None:
+            print "FAIL: %s\n  format: %s\n  values: %r" % (
+                err, msgformat, values)
+            sys.exit(-1)
+    print "OK: compiled encoders and parsers match"
+
+if __name__ == '__main__':
+    main()
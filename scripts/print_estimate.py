@@ -0,0 +1,567 @@
+#!/usr/bin/env python2
+# Estimate the print time of a g-code file with the host look-ahead code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, math, time, types, logging, optparse, ConfigParser
+import itertools, multiprocessing
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy/extras'))
+import klippy, toolhead, extruder, cartesian, corexy, homing
+import sdcard_file
+
+# Minimum Z increase of an extruding move that starts a new layer
+LAYER_MIN_HEIGHT = .010
+# Minimum number of moves planned together (see GCodeReader)
+CHUNK_MOVES = 20000
+# Approximate number of bytes between entries of the print time index
+INDEX_STRIDE = 4096
+
+# Stand-in for the klippy Printer class during config parsing
+class SimPrinter:
+    def __init__(self):
+        self.logger = logging.getLogger('printer')
+        self.all_config_options = {}
+
+# Accumulate the planned timing of every flushed move
+class MoveStats:
+    def __init__(self, bucket_v):
+        self.bucket_v = bucket_v
+        self.move_count = self.error_count = 0
+        self.first_error = None
+        self.move_t = self.extrude_only_t = self.dwell_t = 0.
+        self.velocity_t = {}
+        # Time spent at each extrusion height (in order of the moves)
+        self.segments = [[None, 0.]]
+        # Print time at the end of the moves before each file offset
+        self.marks = []
+    def _add_velocity(self, v1, v2, t):
+        # Velocity changes linearly with time during accel/decel, so
+        # the time spent in each bucket is proportional to its width
+        if not t:
+            return
+        if v1 > v2:
+            v1, v2 = v2, v1
+        bucket_v = self.bucket_v
+        velocity_t = self.velocity_t
+        b = int(v1 / bucket_v)
+        last_b = int(v2 / bucket_v)
+        if b < last_b:
+            inv_dv = t / (v2 - v1)
+            while b < last_b:
+                bucket_end_v = (b + 1) * bucket_v
+                velocity_t[b] = (velocity_t.get(b, 0.)
+                                 + (bucket_end_v - v1) * inv_dv)
+                v1 = bucket_end_v
+                b += 1
+            t = (v2 - v1) * inv_dv
+        velocity_t[b] = velocity_t.get(b, 0.) + t
+    def note_move(self, move):
+        move_t = move.accel_t + move.cruise_t + move.decel_t
+        self.move_count += 1
+        self.move_t += move_t
+        if not move.is_kinematic_move:
+            self.extrude_only_t += move_t
+            self.segments[-1][1] += move_t
+            return
+        if move.axes_d[3] > 0. and move.end_pos[2] != self.segments[-1][0]:
+            self.segments.append([move.end_pos[2], move_t])
+        else:
+            self.segments[-1][1] += move_t
+        self._add_velocity(move.start_v, move.cruise_v, move.accel_t)
+        self._add_velocity(move.cruise_v, move.cruise_v, move.cruise_t)
+        self._add_velocity(move.cruise_v, move.end_v, move.decel_t)
+    def note_dwell(self, delay):
+        self.dwell_t += delay
+        self.segments[-1][1] += delay
+    def note_mark(self, offset, print_time):
+        self.marks.append((offset, print_time))
+    def note_error(self, msg):
+        self.error_count += 1
+        if self.first_error is None:
+            self.first_error = msg
+    def merge(self, other):
+        start_t = self.get_total_time()
+        self.marks.extend([(offset, start_t + t)
+                           for offset, t in other.marks])
+        self.move_count += other.move_count
+        self.move_t += other.move_t
+        self.extrude_only_t += other.extrude_only_t
+        self.dwell_t += other.dwell_t
+        for b, t in other.velocity_t.items():
+            self.velocity_t[b] = self.velocity_t.get(b, 0.) + t
+        self.segments.extend(other.segments)
+        if other.error_count:
+            if self.first_error is None:
+                self.first_error = other.first_error
+            self.error_count += other.error_count
+    def get_layers(self):
+        # A layer starts with the first extruding move that is at
+        # least LAYER_MIN_HEIGHT above the start of the previous layer
+        # (so z-hops and travel moves don't start a new layer)
+        layers = []
+        layer_z = None
+        layer_t = 0.
+        for z, t in self.segments:
+            if z is not None:
+                if layer_z is None:
+                    layer_z = z
+                elif z >= layer_z + LAYER_MIN_HEIGHT:
+                    layers.append((layer_z, layer_t))
+                    layer_z = z
+                    layer_t = 0.
+            layer_t += t
+        if layer_z is not None:
+            layers.append((layer_z, layer_t))
+        return layers
+    def get_total_time(self):
+        return self.move_t + self.dwell_t
+
+# Kinematics using the configured kinematics' check_move() limits
+class SimKinematics:
+    kinematics = {'cartesian': cartesian.CartKinematics,
+                  'corexy': corexy.CoreXYKinematics,
+                  'coreyx': corexy.CoreYXKinematics}
+    def __init__(self, th, config):
+        self.toolhead = th
+        kin_name = config.get('kinematics')
+        if kin_name not in self.kinematics:
+            raise config.error("Kinematics '%s' not supported" % (kin_name,))
+        kin_class = self.kinematics[kin_name]
+        self.name = kin_class.name
+        self.check_move = types.MethodType(kin_class.check_move.im_func, self)
+        max_velocity, max_accel = th.get_max_velocity()
+        self.max_z_velocity = config.getfloat(
+            'max_z_velocity', max_velocity, above=0., maxval=max_velocity)
+        self.max_z_accel = config.getfloat(
+            'max_z_accel', max_accel, above=0., maxval=max_accel)
+        self.limits = [(1.0, -1.0)] * 3
+        self.home_pos = [
+            config.getsection('stepper_' + axis).getfloat(
+                'position_endstop', 0.)
+            for axis in 'xyz']
+    def move(self, print_time, move):
+        self.toolhead.stats.note_move(move)
+
+# Extruder using the real check_move() limits and look-ahead code
+class SimExtruder:
+    check_move = extruder.PrinterExtruder.__dict__['check_move']
+    calc_junction = extruder.PrinterExtruder.__dict__['calc_junction']
+    lookahead = extruder.PrinterExtruder.__dict__['lookahead']
+    class heater:
+        can_extrude = True
+    def __init__(self, th, config):
+        self.toolhead = th
+        self.name = config.get_name()
+        self.logger = config.get_printer().logger.getChild(self.name)
+        self.nozzle_diameter = config.getfloat('nozzle_diameter', above=0.)
+        filament_diameter = config.getfloat(
+            'filament_diameter', minval=self.nozzle_diameter)
+        self.filament_area = math.pi * (filament_diameter * .5)**2
+        max_cross_section = config.getfloat(
+            'max_extrude_cross_section', 4. * self.nozzle_diameter**2
+            , above=0.)
+        self.max_extrude_ratio = max_cross_section / self.filament_area
+        max_velocity, max_accel = th.get_max_velocity()
+        self.max_e_velocity = config.getfloat(
+            'max_extrude_only_velocity', max_velocity * self.max_extrude_ratio
+            , above=0.)
+        self.max_e_accel = config.getfloat(
+            'max_extrude_only_accel', max_accel * self.max_extrude_ratio
+            , above=0.)
+        self.max_e_dist = config.getfloat(
+            'max_extrude_only_distance', 50., minval=0.)
+        self.pressure_advance = config.getfloat(
+            'pressure_advance', 0., minval=0.)
+        self.pressure_advance_lookahead_time = config.getfloat(
+            'pressure_advance_lookahead_time', 0.010, minval=0.)
+        self.extrude_factor = config.getfloat(
+            'extrusion_factor', 1.0, minval=0.1)
+    def move(self, print_time, move):
+        if not move.is_kinematic_move:
+            self.toolhead.stats.note_move(move)
+
+# Tool head with the printer's velocity limits that only tracks time
+class SimToolHead:
+    def __init__(self, config):
+        self.stats = None
+        self.max_velocity = config.getfloat('max_velocity', above=0.)
+        self.max_accel = config.getfloat('max_accel', above=0.)
+        self.max_accel_to_decel_ratio = config.getfloat(
+            'max_accel_to_decel_ratio', default=1.0, above=0.,
+            maxval=1.)
+        max_accel_to_decel = config.getfloat(
+            'max_accel_to_decel', default=None
+            , above=0., maxval=self.max_accel)
+        if max_accel_to_decel is None:
+            max_accel_to_decel = self.max_accel * self.max_accel_to_decel_ratio
+        self.max_accel_to_decel = min(max_accel_to_decel, self.max_accel)
+        self.junction_deviation = config.getfloat(
+            'junction_deviation', 0.02, minval=0.)
+        self.config_max_velocity = self.max_velocity
+        self.config_max_accel = self.max_accel
+        self.config_junction_deviation = self.junction_deviation
+        self.move_queue = toolhead.MoveQueue()
+        self.move_queue.set_flush_time(config.getfloat(
+            'buffer_time_high', 2.000, above=0.))
+        self.sw_limit_check_enabled = False
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.print_time = 0.
+        self.kin = SimKinematics(self, config)
+        extruders = sorted([
+            c for c in config.get_prefix_sections('extruder')
+            if c.get_name()[8:].isdigit()], key=lambda c: c.get_name())
+        if not extruders:
+            raise config.error("No extruder section found")
+        self.extruder = SimExtruder(self, extruders[0])
+        self.move_queue.set_extruder(self.extruder)
+    def get_max_velocity(self):
+        return self.max_velocity, self.max_accel
+    def get_next_move_time(self):
+        return self.print_time
+    def update_move_time(self, movetime):
+        self.print_time += movetime
+    def move(self, newpos, speed):
+        move = toolhead.Move(self, self.commanded_pos, newpos,
+                             min(speed, self.max_velocity))
+        if not move.move_d:
+            return
+        try:
+            if move.is_kinematic_move:
+                self.kin.check_move(move)
+            if move.axes_d[3]:
+                self.extruder.check_move(move)
+        except homing.EndstopError as e:
+            # Klippy would report an error and skip the move
+            self.stats.note_error(str(e).split('\n')[0])
+            return
+        self.commanded_pos[:] = newpos
+        self.move_queue.add_move(move)
+    def flush(self):
+        self.move_queue.flush()
+    def dwell(self, delay):
+        self.flush()
+        self.print_time += delay
+        self.stats.note_dwell(delay)
+    def set_position(self, newpos):
+        self.flush()
+        self.commanded_pos[:] = newpos
+    def register_lookahead_callback(self, callback):
+        last_move = self.move_queue.get_last()
+        if last_move is None:
+            callback(self.print_time)
+            return
+        if last_move.timing_callbacks is None:
+            last_move.timing_callbacks = []
+        last_move.timing_callbacks.append(callback)
+    def mark(self, offset):
+        self.register_lookahead_callback(
+            (lambda print_time: self.stats.note_mark(offset, print_time)))
+    def get_limits(self):
+        return (self.max_velocity, self.max_accel, self.max_accel_to_decel,
+                self.max_accel_to_decel_ratio, self.junction_deviation)
+    def set_limits(self, limits):
+        (self.max_velocity, self.max_accel, self.max_accel_to_decel,
+         self.max_accel_to_decel_ratio, self.junction_deviation) = limits
+    def set_velocity_limit(self, params):
+        # Same parameters and limits as cmd_SET_VELOCITY_LIMIT
+        self.max_velocity = min(params.get('VELOCITY', self.max_velocity),
+                                self.config_max_velocity)
+        self.max_accel = min(params.get('ACCEL', self.max_accel),
+                             self.config_max_accel)
+        self.junction_deviation = min(
+            params.get('JUNCTION_DEVIATION', self.junction_deviation),
+            self.config_junction_deviation)
+        self.max_accel_to_decel_ratio = params.get(
+            'ACCEL_TO_DECEL_RATIO', self.max_accel_to_decel_ratio)
+        max_accel_to_decel = params.get(
+            'ACCEL_TO_DECEL', self.max_accel * self.max_accel_to_decel_ratio)
+        self.max_accel_to_decel = min(max_accel_to_decel, self.max_accel)
+    def set_accel(self, params):
+        # Same parameters and limits as cmd_M204
+        accel = params.get('P', params.get('S'))
+        if accel is not None and 0. < accel:
+            self.max_accel = min(accel, self.config_max_accel)
+        decel = params.get('D', self.max_accel * self.max_accel_to_decel_ratio)
+        self.max_accel_to_decel = min(decel, self.max_accel)
+
+def load_config(filename):
+    fileconfig = ConfigParser.RawConfigParser()
+    if not fileconfig.read(filename):
+        raise ConfigParser.Error("Unable to open config file %s" % (
+            filename,))
+    return SimToolHead(klippy.ConfigWrapper(SimPrinter(), fileconfig,
+                                            'printer'))
+
+def parse_params(words):
+    params = {}
+    for w in words:
+        try:
+            params[w[0]] = float(w[1:])
+        except ValueError:
+            pass
+    return params
+
+def parse_extended_params(words):
+    params = {}
+    for w in words:
+        key, sep, value = w.partition('=')
+        try:
+            params[key] = float(value)
+        except ValueError:
+            pass
+    return params
+
+# Translate the g-code commands that affect motion timing into lists
+# of tool head calls.  The look-ahead of a move never depends on the
+# moves before a point where the head comes to a full stop, so the
+# lists are split at those points (before a dwell, a position change,
+# or an extrude only move) and may be planned independently.
+class GCodeReader:
+    def __init__(self, f, th, mark_stride=None):
+        self.f = f
+        self.th = th
+        self.mark_stride = mark_stride
+        self.line_count = self.offset = 0
+    def _start_chunk(self, last_pos):
+        return [('set_position', list(last_pos)),
+                ('set_limits', self.th.get_limits())]
+    def chunks(self):
+        th = self.th
+        absolutecoord = absoluteextrude = True
+        base_pos = [0., 0., 0., 0.]
+        last_pos = [0., 0., 0., 0.]
+        speed = 25.
+        speed_factor = 1. / 60.
+        extrude_factor = th.extruder.extrude_factor
+        prev_pos = list(last_pos)
+        chunk = self._start_chunk(prev_pos)
+        chunk_append = chunk.append
+        mark_stride = self.mark_stride
+        next_mark = 0
+        for line in self.f:
+            if mark_stride is not None and self.offset >= next_mark:
+                chunk_append(('mark', self.offset))
+                next_mark = self.offset + mark_stride
+            self.line_count += 1
+            self.offset += len(line)
+            if ';' in line:
+                line = line[:line.index(';')]
+            words = line.upper().split()
+            if not words:
+                continue
+            cmd = words[0]
+            is_split_point = False
+            if cmd == 'G1' or cmd == 'G0':
+                have_xyz = False
+                last_e = last_pos[3]
+                for w in words[1:]:
+                    axis = w[0]
+                    try:
+                        v = float(w[1:])
+                    except ValueError:
+                        continue
+                    if axis == 'X':
+                        i = 0
+                    elif axis == 'Y':
+                        i = 1
+                    elif axis == 'Z':
+                        i = 2
+                    elif axis == 'E':
+                        v *= extrude_factor
+                        if not absolutecoord or not absoluteextrude:
+                            last_pos[3] += v
+                        else:
+                            last_pos[3] = v + base_pos[3]
+                        continue
+                    elif axis == 'F':
+                        if v > 0.:
+                            speed = v * speed_factor
+                        continue
+                    else:
+                        continue
+                    have_xyz = True
+                    if not absolutecoord:
+                        last_pos[i] += v
+                    else:
+                        last_pos[i] = v + base_pos[i]
+                op = ('move', list(last_pos), speed)
+                is_split_point = not have_xyz and last_pos[3] != last_e
+            elif cmd == 'G90':
+                absolutecoord = True
+                continue
+            elif cmd == 'G91':
+                absolutecoord = False
+                continue
+            elif cmd == 'M82':
+                absoluteextrude = True
+                continue
+            elif cmd == 'M83':
+                absoluteextrude = False
+                continue
+            elif cmd == 'G92':
+                params = parse_params(words[1:])
+                for i, axis in enumerate('XYZE'):
+                    if axis in params:
+                        offset = params[axis]
+                        if i == 3:
+                            offset *= extrude_factor
+                        base_pos[i] = last_pos[i] - offset
+                if not params:
+                    base_pos = list(last_pos)
+                continue
+            elif cmd == 'G4' or cmd == 'G04':
+                params = parse_params(words[1:])
+                if 'S' in params:
+                    op = ('dwell', max(params['S'], 0.))
+                else:
+                    op = ('dwell', max(params.get('P', 0.), 0.) / 1000.)
+                is_split_point = True
+            elif cmd == 'G28':
+                # The homing moves themselves are not timed
+                params = parse_params(words[1:])
+                axes = [i for i, axis in enumerate('XYZ') if axis in params]
+                if not axes:
+                    axes = [0, 1, 2]
+                for i in axes:
+                    last_pos[i] = base_pos[i] = th.kin.home_pos[i]
+                op = ('set_position', list(last_pos))
+                is_split_point = True
+            elif cmd == 'M220':
+                value = parse_params(words[1:]).get('S', 100.)
+                if value > 0.:
+                    speed_factor = value / (60. * 100.)
+                continue
+            elif cmd == 'M221':
+                value = parse_params(words[1:]).get('S', 100.)
+                if value > 0.:
+                    extrude_factor = value / 100.
+                continue
+            elif cmd == 'M204':
+                op = ('set_accel', parse_params(words[1:]))
+                th.set_accel(op[1])
+            elif cmd == 'SET_VELOCITY_LIMIT':
+                op = ('set_velocity_limit', parse_extended_params(words[1:]))
+                th.set_velocity_limit(op[1])
+            else:
+                continue
+            if is_split_point and len(chunk) >= CHUNK_MOVES:
+                yield chunk
+                chunk = self._start_chunk(prev_pos)
+                chunk_append = chunk.append
+            chunk_append(op)
+            if op[0] == 'move' or op[0] == 'set_position':
+                prev_pos = op[1]
+        if mark_stride is not None:
+            chunk_append(('mark', self.offset))
+        yield chunk
+
+# Worker state for plan_chunk()
+sim_toolhead = None
+sim_bucket_v = None
+
+def init_worker(config_file, bucket_v):
+    global sim_toolhead, sim_bucket_v
+    sim_toolhead = load_config(config_file)
+    sim_bucket_v = bucket_v
+
+def plan_chunk(chunk):
+    th = sim_toolhead
+    th.stats = stats = MoveStats(sim_bucket_v)
+    th.print_time = 0.
+    for op in chunk:
+        getattr(th, op[0])(*op[1:])
+    th.flush()
+    return stats
+
+# Write the file offset to print time map used by virtual_sdcard
+def write_index(filename, gcode_file, stats):
+    st = os.stat(gcode_file)
+    lines = ["%d %d %.3f" % (st.st_size, int(st.st_mtime),
+                             stats.get_total_time())]
+    lines.extend(["%d %.3f" % (offset, t) for offset, t in stats.marks])
+    tmpname = filename + ".tmp"
+    f = open(tmpname, 'wb')
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    os.rename(tmpname, filename)
+
+def format_time(t):
+    t = int(t + .5)
+    return "%d:%02d:%02d" % (t // 3600, (t // 60) % 60, t % 60)
+
+def main():
+    usage = "%prog [options] <printer config> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--bucket", type="float", default=10.,
+                    help="velocity histogram bucket size in mm/s")
+    opts.add_option("-l", "--layers", action="store_true",
+                    help="report the time of every layer")
+    opts.add_option("-j", "--jobs", type="int", default=1,
+                    help="number of processes planning moves")
+    opts.add_option("-i", "--index", type="string", dest="index",
+                    help="write a file offset to print time index")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    if options.bucket <= 0.:
+        opts.error("Bucket size must be positive")
+    config_file, gcode_file = args
+    try:
+        th = load_config(config_file)
+    except ConfigParser.Error as e:
+        sys.stderr.write("Config error: %s\n" % (e,))
+        sys.exit(-1)
+    starttime = time.time()
+    f = sdcard_file.open_file(gcode_file)
+    mark_stride = None
+    if options.index:
+        mark_stride = INDEX_STRIDE
+    reader = GCodeReader(f, th, mark_stride)
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs, init_worker,
+                                    (config_file, options.bucket))
+        results = pool.imap(plan_chunk, reader.chunks())
+    else:
+        init_worker(config_file, options.bucket)
+        results = itertools.imap(plan_chunk, reader.chunks())
+    stats = MoveStats(options.bucket)
+    for chunk_stats in results:
+        stats.merge(chunk_stats)
+    file_size = f.tell()
+    f.close()
+    if options.index:
+        write_index(options.index, gcode_file, stats)
+    run_time = time.time() - starttime
+    # Report
+    total_t = stats.get_total_time()
+    print "Estimated print time: %s (%.3fs)" % (format_time(total_t), total_t)
+    print "  moves=%d move_time=%.3f extrude_only_time=%.3f dwell_time=%.3f" % (
+        stats.move_count, stats.move_t, stats.extrude_only_t, stats.dwell_t)
+    if stats.error_count:
+        print "  %d moves rejected by the printer limits (first: %s)" % (
+            stats.error_count, stats.first_error)
+    layers = stats.get_layers()
+    if layers:
+        layer_times = [t for z, t in layers]
+        print "Layers: %d (min=%.3fs avg=%.3fs max=%.3fs)" % (
+            len(layers), min(layer_times),
+            sum(layer_times) / len(layers), max(layer_times))
+        if options.layers:
+            for i, (z, t) in enumerate(layers):
+                print "  layer %4d z=%8.3f %10.3fs" % (i, z, t)
+    velocity_t = stats.velocity_t
+    kin_t = sum(velocity_t.values())
+    if kin_t:
+        print "Velocity histogram (mm/s):"
+        for b in range(max(velocity_t) + 1):
+            t = velocity_t.get(b, 0.)
+            print "  %7.1f-%-7.1f %10.3fs %5.1f%%" % (
+                b * options.bucket, (b + 1) * options.bucket, t,
+                100. * t / kin_t)
+    print "Processed %d lines (%.1fMB) in %.3fs (%.0f lines/s, %.2fMB/s)" % (
+        reader.line_count, file_size / 1000000., run_time,
+        reader.line_count / max(run_time, .001),
+        file_size / 1000000. / max(run_time, .001))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+# Benchmark the reactor timer scheduling with many active timers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, time, random, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# The timer handling as implemented before the timer heap
+class LegacyReactor(reactor.Reactor):
+    def __init__(self):
+        reactor.Reactor.__init__(self)
+        self._timers = []
+    def _note_time(self, t):
+        nexttime = t.waketime
+        if nexttime < self._next_timer:
+            self._next_timer = nexttime
+    def update_timer(self, t, nexttime):
+        t.waketime = nexttime
+        self._note_time(t)
+    def register_timer(self, callback, waketime = reactor.Reactor.NEVER):
+        handler = reactor.ReactorTimer(callback, waketime)
+        timers = list(self._timers)
+        timers.append(handler)
+        self._timers = timers
+        self._note_time(handler)
+        return handler
+    def unregister_timer(self, handler):
+        timers = list(self._timers)
+        timers.pop(timers.index(handler))
+        self._timers = timers
+    def _check_timers(self, eventtime):
+        if eventtime < self._next_timer:
+            return min(1., max(.001, self._next_timer - eventtime))
+        self._next_timer = self.NEVER
+        g_dispatch = self._g_dispatch
+        for t in self._timers:
+            if eventtime >= t.waketime:
+                t.waketime = self.NEVER
+                t.waketime = t.callback(eventtime)
+                if g_dispatch is not self._g_dispatch:
+                    self._end_greenlet(g_dispatch)
+                    return 0.
+            self._note_time(t)
+        if eventtime >= self._next_timer:
+            return 0.
+        return min(1., max(.001, self._next_timer - self.monotonic()))
+
+# Timer that reschedules itself with a fixed period
+class PeriodicTimer:
+    def __init__(self, bench, timer_id, period):
+        self.bench = bench
+        self.timer_id = timer_id
+        self.period = period
+        self.timer = bench.reactor.register_timer(self.callback, period)
+    def callback(self, eventtime):
+        self.bench.events.append((eventtime, self.timer_id))
+        return eventtime + self.period
+
+# Timer registered for a single wakeup and then replaced (as done by
+# reactor.pause() for each greenlet sleep)
+class SleepTimer:
+    def __init__(self, bench, timer_id, delay):
+        self.bench = bench
+        self.timer_id = timer_id
+        self.delay = delay
+        self.timer = bench.reactor.register_timer(self.callback, delay)
+    def callback(self, eventtime):
+        self.bench.events.append((eventtime, self.timer_id))
+        self.bench.reactor.unregister_timer(self.timer)
+        self.timer = self.bench.reactor.register_timer(
+            self.callback, eventtime + self.delay)
+        return self.bench.reactor.NEVER
+
+class TimerBench:
+    def __init__(self, reactor_class, count, sleepers, seed):
+        self.reactor = reactor_class()
+        self.clock = 0.
+        self.reactor.monotonic = lambda: self.clock
+        self.events = []
+        rnd = random.Random(seed)
+        self.timers = [PeriodicTimer(self, i, rnd.uniform(.010, 1.))
+                       for i in range(count)]
+        self.timers.extend([SleepTimer(self, count + i, rnd.uniform(.001, .1))
+                            for i in range(sleepers)])
+    def run(self, duration):
+        check_timers = self.reactor._check_timers
+        passes = []
+        starttime = time.time()
+        while self.clock < duration:
+            start_events = len(self.events)
+            timeout = check_timers(self.clock)
+            passes.append(sorted(self.events[start_events:]))
+            self.clock += timeout
+        return time.time() - starttime, passes
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="string", default="10,100,300,1000",
+                    help="comma separated list of periodic timer counts")
+    opts.add_option("-s", "--sleepers", type="int", default=20,
+                    help="number of pause() style sleeping timers")
+    opts.add_option("-d", "--duration", type="float", default=30.,
+                    help="simulated run time in seconds")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print "%8s %10s %14s %14s" % ("timers", "events", "legacy(us/ev)",
+                                  "heap(us/ev)")
+    for count in [int(c) for c in options.timers.split(',')]:
+        legacy = TimerBench(LegacyReactor, count, options.sleepers, count)
+        legacy_time, legacy_passes = legacy.run(options.duration)
+        heap = TimerBench(reactor.Reactor, count, options.sleepers, count)
+        heap_time, heap_passes = heap.run(options.duration)
+        if legacy_passes != heap_passes:
+            print "FAIL: timer callbacks differ with %d timers" % (count,)
+            sys.exit(-1)
+        events = len(heap.events)
+        print "%8d %10d %14.3f %14.3f" % (
+            count, events, legacy_time * 1000000. / events,
+            heap_time * 1000000. / events)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+# Measure timer wakeup jitter and async callback latency of the reactors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, random, threading, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+REACTORS = [('select', 'SelectReactor'), ('poll', 'PollReactor'),
+            ('epoll', 'EPollReactor')]
+
+# Reschedule a timer at random delays and record how late each wakeup is
+class TimerJitter:
+    def __init__(self, r, count, min_delay, max_delay, seed):
+        self.reactor = r
+        self.count = count
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.rnd = random.Random(seed)
+        self.lateness = []
+        self.waketime = r.monotonic() + max_delay
+        self.timer = r.register_timer(self.callback, self.waketime)
+    def callback(self, eventtime):
+        self.lateness.append(self.reactor.monotonic() - self.waketime)
+        if len(self.lateness) >= self.count:
+            self.reactor.end()
+            return self.reactor.NEVER
+        self.waketime = eventtime + self.rnd.uniform(
+            self.min_delay, self.max_delay)
+        return self.waketime
+
+# Submit bursts of async callbacks from a background thread (as done by
+# serialhdl) and record the latency of each callback
+class AsyncBurst:
+    def __init__(self, r, bursts, burst_size):
+        self.reactor = r
+        self.bursts = bursts
+        self.burst_size = burst_size
+        self.latency = []
+        self.signals = self.wakeups = 0
+        self.done = threading.Event()
+        signal_async = r._signal_async
+        def count_signals():
+            self.signals += 1
+            signal_async()
+        r._signal_async = count_signals
+        got_pipe_signal = r._got_pipe_signal
+        def count_wakeups(eventtime):
+            self.wakeups += 1
+            got_pipe_signal(eventtime)
+        r._got_pipe_signal = count_wakeups
+        r.register_timer(self.start, r.NOW)
+    def start(self, eventtime):
+        self.thread = threading.Thread(target=self.background)
+        self.thread.start()
+        return self.reactor.NEVER
+    def background(self):
+        r = self.reactor
+        for i in range(self.bursts):
+            self.done.clear()
+            for j in range(self.burst_size):
+                sendtime = r.monotonic()
+                r.register_async_callback(
+                    (lambda e, s=sendtime: self.note(s)))
+            self.done.wait(1.)
+        r.register_async_callback(lambda e: r.end())
+    def note(self, sendtime):
+        self.latency.append(self.reactor.monotonic() - sendtime)
+        if not len(self.latency) % self.burst_size:
+            self.done.set()
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    count = len(values)
+    return "avg=%8.1f p50=%8.1f p99=%8.1f max=%8.1f" % (
+        sum(values) * 1000000. / count, values[count // 2] * 1000000.,
+        values[min(count - 1, int(count * .99))] * 1000000.,
+        values[-1] * 1000000.)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", default=2000,
+                    help="number of timer wakeups to measure")
+    opts.add_option("--min_delay", type="float", default=.0002,
+                    help="minimum timer delay in seconds")
+    opts.add_option("--max_delay", type="float", default=.005,
+                    help="maximum timer delay in seconds")
+    opts.add_option("-b", "--bursts", type="int", default=200,
+                    help="number of async callback bursts")
+    opts.add_option("-s", "--burst_size", type="int", default=20,
+                    help="async callbacks per burst")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print "Default reactor: %s" % (reactor.Reactor.__name__,)
+    print "Timer lateness (us) over %d wakeups:" % (options.count,)
+    for name, class_name in REACTORS:
+        r = getattr(reactor, class_name)()
+        jitter = TimerJitter(r, options.count, options.min_delay,
+                             options.max_delay, 0)
+        r.run()
+        print "  %-6s %s" % (name, summarize(jitter.lateness))
+    print "Async callback latency (us), %d bursts of %d:" % (
+        options.bursts, options.burst_size)
+    for name, class_name in REACTORS:
+        r = getattr(reactor, class_name)()
+        burst = AsyncBurst(r, options.bursts, options.burst_size)
+        r.run()
+        burst.thread.join()
+        print "  %-6s %s signals=%d wakeups=%d" % (
+            name, summarize(burst.latency), burst.signals, burst.wakeups)
+
+if __name__ == '__main__':
+    main()
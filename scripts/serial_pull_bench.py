@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+# Measure the message throughput of the serialhdl background thread
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, time, socket, threading, resource, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor, serialhdl, msgproto
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# Messages typically streamed by an mcu during a print
+RESPONSES = {
+    10: "analog_in_state oid=%c next_clock=%u value=%hu",
+    11: "clock clock=%u",
+    12: "stats count=%u sum=%u sumsq=%u",
+    13: "thermocouple_result oid=%c next_clock=%u value=%u fault=%c",
+}
+
+def get_thread_cpu():
+    ru = resource.getrusage(RUSAGE_THREAD)
+    return ru.ru_utime + ru.ru_stime
+
+# The background thread as implemented before the batch pull
+class LegacySerialReader(serialhdl.SerialReader):
+    def _bg_thread(self):
+        response = self.ffi_main.new('struct pull_queue_message *')
+        while 1:
+            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
+            count = response.len
+            if count <= 0:
+                break
+            params = self.msgparser.parse(response.msg[0:count])
+            params['#sent_time'] = response.sent_time
+            params['#receive_time'] = response.receive_time
+            hdl = (params['#name'], params.get('oid'))
+            with self.lock:
+                hdl = self.handlers.get(hdl, self.handle_default)
+            try:
+                hdl(params)
+            except:
+                self.logger.exception("Exception in serial callback")
+
+def build_stream(count, oids):
+    msgparser = msgproto.MessageParser()
+    formats = dict((msgid, msgproto.MessageFormat(msgid, msgformat))
+                   for msgid, msgformat in RESPONSES.items())
+    out = []
+    for i in range(count):
+        kind = i % 8
+        if kind < 4:
+            cmd = formats[10].encode([i % oids, i * 1000, i & 0xffff])
+        elif kind == 4:
+            cmd = formats[11].encode([i * 1000])
+        elif kind == 5:
+            cmd = formats[12].encode([i, i * 7, i * 13])
+        else:
+            cmd = formats[13].encode([i % oids, i * 1000, i * 3, 0])
+        out.append(msgparser.encode(0, ''.join(map(chr, cmd))))
+    return ''.join(out)
+
+class StreamTest:
+    def __init__(self, reader_class, stream, count, oids):
+        self.count = count
+        self.received = 0
+        self.done = threading.Event()
+        self.reader = reader_class(reactor.Reactor(), None, 0)
+        self.reader.msgparser.process_identify(msgproto.json.dumps({
+            'messages': RESPONSES, 'commands': [],
+            'responses': RESPONSES.keys()}), decompress=False)
+        for oid in range(oids):
+            self.reader.register_callback(
+                self.handle, 'analog_in_state', oid)
+            self.reader.register_callback(
+                self.handle, 'thermocouple_result', oid)
+        self.reader.register_callback(self.handle, 'clock')
+        self.reader.register_callback(self.handle, 'stats')
+        self.sock, peer = socket.socketpair()
+        self.peer = peer
+        self.stream = stream
+        self.bg_cpu = 0.
+        orig_bg_thread = self.reader._bg_thread
+        def bg_thread():
+            start_cpu = get_thread_cpu()
+            orig_bg_thread()
+            self.bg_cpu = get_thread_cpu() - start_cpu
+        self.reader._bg_thread = bg_thread
+    def handle(self, params):
+        self.received += 1
+        if self.received >= self.count:
+            self.done.set()
+    def run(self, planner):
+        reader = self.reader
+        reader.serialqueue = reader.ffi_lib.serialqueue_alloc(
+            self.sock.fileno(), 0)
+        reader.background_thread = threading.Thread(target=reader._bg_thread)
+        reader.background_thread.start()
+        writer = threading.Thread(target=self.peer.sendall,
+                                  args=(self.stream,))
+        starttime = time.time()
+        writer.start()
+        # Simulate planner work competing for the GIL
+        loops = 0
+        while planner and not self.done.is_set():
+            sum([i * i for i in range(100)])
+            loops += 1
+        self.done.wait(60.)
+        elapsed = time.time() - starttime
+        writer.join()
+        reader.ffi_lib.serialqueue_exit(reader.serialqueue)
+        reader.background_thread.join()
+        reader.ffi_lib.serialqueue_free(reader.serialqueue)
+        reader.serialqueue = None
+        self.sock.close()
+        self.peer.close()
+        return elapsed, loops
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", default=200000,
+                    help="number of messages to stream")
+    opts.add_option("-o", "--oids", type="int", default=8,
+                    help="number of sensor oids")
+    opts.add_option("-p", "--planner", action="store_true",
+                    help="run a cpu bound loop in the main thread")
+    opts.add_option("-n", "--loops", type="int", default=3,
+                    help="number of runs (best is reported)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    stream = build_stream(options.count, options.oids)
+    print "%d messages (%d bytes)" % (options.count, len(stream))
+    for name, reader_class in [('legacy', LegacySerialReader),
+                               ('batch', serialhdl.SerialReader)]:
+        best = None
+        for i in range(options.loops):
+            test = StreamTest(reader_class, stream, options.count,
+                              options.oids)
+            elapsed, loops = test.run(options.planner)
+            if best is None or test.bg_cpu < best[0].bg_cpu:
+                best = (test, elapsed, loops)
+        test, elapsed, loops = best
+        msg = "%-7s %9.0f msgs/s bg_cpu=%.3fs (%.2fus/msg)" % (
+            name, test.received / elapsed, test.bg_cpu,
+            test.bg_cpu * 1000000. / max(1, test.received))
+        if options.planner:
+            msg += " planner=%.0f loops/s" % (loops / elapsed,)
+        print msg
+        if test.received != options.count:
+            print "FAIL: only %d of %d messages received" % (
+                test.received, options.count)
+            sys.exit(-1)
+
+if __name__ == '__main__':
+    main()